@@ -0,0 +1,237 @@
+'''
+asyncio peer connection
+Same API and state as PeerConnection, but connect/handshake/receive are
+coroutines on an asyncio transport, so hundreds of peers share one event loop
+(the FastAPI one) instead of a thread each. The transport reads straight into
+the connection's MessageBuffer (BufferedProtocol, same recv_into path as the
+sync connection), sends only queue bytes on the transport, they never block
+'''
+
+import asyncio
+import time
+from .peer import PeerConnection
+from .framing import MessageBuffer
+
+
+class _PeerProtocol(asyncio.BufferedProtocol):
+    """
+    feeds the transport's reads into the connection's inbox and wakes the
+    coroutine waiting for data, reading pauses while the inbox is full
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def connection_made(self, transport):
+        self.connection.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.connection.inbox.free_view()
+
+    def buffer_updated(self, nbytes):
+        connection = self.connection
+        connection.inbox.produced(nbytes)
+        if connection.inbox.available >= len(connection.inbox.buffer): #nowhere to read into
+            connection._pause_reading()
+        connection._wake()
+
+    def eof_received(self):
+        self.connection.eof = True
+        self.connection._wake()
+        return False #close the transport
+
+    def connection_lost(self, exc):
+        connection = self.connection
+        connection.connected = False
+        connection.eof = True
+        connection._wake()
+        connection._resume_writers()
+
+    def pause_writing(self):
+        self.connection.write_paused = True
+
+    def resume_writing(self):
+        self.connection._resume_writers()
+
+
+class AsyncPeerConnection(PeerConnection):
+    KEEPALIVE_INTERVAL = 120 #send a keep-alive after this long without writing
+
+    def __init__(self, ip, port, info_hash, peer_id, piece_count=None):
+        super().__init__(ip, port, info_hash, peer_id, piece_count)
+        self.transport = None
+        self.loop = None
+        self.eof = False #peer closed its side, only the buffered bytes are left
+        self.reading_paused = False
+        self.write_paused = False #transport buffer above its high-water mark
+        self.last_sent = 0.0
+        self._waiter = None #future of the coroutine waiting for more data
+        self._drain_waiters = []
+        self._keepalive_task = None
+
+    async def connect(self, timeout=5):
+        self.inbox = MessageBuffer()
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: _PeerProtocol(self), self.ip, self.port), timeout)
+        except (asyncio.TimeoutError, OSError):
+            self.connected = False
+            return False
+        self.loop = loop
+        self.connected = True
+        self.last_sent = time.monotonic()
+        self._keepalive_task = asyncio.create_task(self._keepalive())
+        return True
+
+    async def handshake(self, timeout=5):
+        if not self.connected:
+            raise Exception("Not connected to peer")
+
+        self._write(self._handshake_message())
+        self.inbox.reserve(68)
+        deadline = time.monotonic() + timeout
+        while self.inbox.available < 68:
+            if self.eof:
+                raise Exception("Connection closed by peer")
+            if not await self._wait_data(deadline):
+                raise Exception("timed out")
+        self._check_handshake(bytes(self.inbox.take(68)))
+        if self.supports_extended:
+            self.send_extended_handshake()
+        return True
+
+    async def receive_message(self, timeout=5):
+        """
+        same as PeerConnection.receive_message: payload is a memoryview into the
+        inbox valid until the next call, None on timeout (nothing is lost)
+        """
+        if self.shaper is not None: #over a rate limit: leave the bytes in the socket for now
+            wait = self.shaper.delay()
+            if wait:
+                self._pause_reading()
+                await asyncio.sleep(wait)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            message = self._next_message()
+            if message is not None:
+                return message
+            if self.eof:
+                self.close()
+                raise Exception("Connection closed by peer")
+            if not await self._wait_data(deadline):
+                return None
+
+    async def _wait_data(self, deadline):
+        """
+        wait until the transport brings more bytes
+        Returns:
+            bool: False on timeout
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        self._resume_reading()
+        self._waiter = self.loop.create_future()
+        try:
+            await asyncio.wait_for(self._waiter, remaining)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiter = None
+        return True
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _pause_reading(self):
+        if not self.reading_paused and self.transport is not None and not self.transport.is_closing():
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        if self.reading_paused and self.transport is not None and not self.transport.is_closing():
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def _flush(self, tail=None): #call with send_lock held, the transport buffers what the socket doesn't take
+        if tail is not None and not self._on_loop():
+            self.outbox.write(tail)
+            tail = None
+        if not len(self.outbox) and tail is None:
+            return True
+        if not self._on_loop(): #e.g. from a hasher thread, transports are not thread safe
+            self.loop.call_soon_threadsafe(self._flush_on_loop)
+            return True
+        data = bytes(self.outbox.pending()) #transport may keep a reference, outbox gets reused
+        self.outbox.sent(len(data))
+        self._write(data)
+        if tail is not None:
+            self._write(tail) #mmap slice, the transport sends it or copies only the unsent rest
+        return True
+
+    def _flush_on_loop(self):
+        try:
+            self.flush()
+        except Exception: #closed meanwhile
+            pass
+
+    def _write(self, data):
+        if self.transport is None or self.transport.is_closing():
+            raise Exception("Connection closed")
+        self.last_sent = time.monotonic()
+        if self._on_loop():
+            self.transport.write(data)
+        else: #e.g. from a hasher thread, transports are not thread safe
+            self.loop.call_soon_threadsafe(self.transport.write, data)
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def drain(self): #wait while the peer is slower than what we queued
+        if not self.connected:
+            raise Exception("Connection closed")
+        if self.write_paused:
+            waiter = self.loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def _resume_writers(self):
+        self.write_paused = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _keepalive(self):
+        try:
+            while self.connected:
+                idle = time.monotonic() - self.last_sent
+                if idle >= self.KEEPALIVE_INTERVAL:
+                    self._write(b'\x00\x00\x00\x00')
+                    idle = 0
+                await asyncio.sleep(self.KEEPALIVE_INTERVAL - idle)
+        except Exception:
+            pass
+
+    def close(self):
+        self.connected = False
+        if self.loop is None:
+            return
+        if self._on_loop():
+            self._close()
+        else:
+            self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        if self._keepalive_task is not None and self._keepalive_task is not asyncio.current_task():
+            self._keepalive_task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        self.eof = True
+        self._wake()
+        self._resume_writers()
@@ -3,90 +3,207 @@ turning torrent bytes python dictionary,
 then we slice some info from dictionary with bencode encoder to make it 20byte infohash
 '''
 
+#token bytes, compared as ints so we never build chr() per token
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+_ZERO = ord('0')
+_NINE = ord('9')
+
+
 class BencodeDecoder:
+    '''
+    iterative decoder over a memoryview of the input (no recursion, no chr per token)
+    also remembers where the top level 'info' dict starts and ends in the input,
+    so info_hash can be SHA1 of the original bytes instead of re-encoding
+    '''
     def __init__(self, data):
-        self.data = data
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        self.raw = data #bytes/bytearray for find() and string slices
+        self.data = memoryview(data) #token reads, info span without copies
         self.index = 0
+        self.info_span = None #(start, end) of raw 'info' dict
 
     def decode(self):
-        return self._decode_next()
-
-    def _decode_next(self): #decoding next elements
-        if self.index >= len(self.data):
-            raise ValueError("Unexpected end of data")
-
-        current = chr(self.data[self.index])
-
-        if current == 'i':
-            return self._decode_int()
-        elif current == 'l':
-            return self._decode_list()
-        elif current == 'd':
-            return self._decode_dict()
-        elif current.isdigit():
-            return self._decode_string()
-        else:
-            raise ValueError(f"Unknown bencode type: {current}")
-
-    def _decode_int(self):
-        self.index += 1  #skip i i<>e
-        end = self.data.index(b'e', self.index)
-        number = int(self.data[self.index:end])
-        self.index = end + 1
-        return number
-
-    def _decode_string(self): # n:<>
-        colon = self.data.index(b':', self.index)
-        length = int(self.data[self.index:colon])
-        self.index = colon + 1
-        string = self.data[self.index:self.index + length]
-        self.index += length
-        return string
-
-    def _decode_list(self): #<>e
-        self.index += 1  #skip l
-        items = []
-        while chr(self.data[self.index]) != 'e':
-            items.append(self._decode_next())
-        self.index += 1  #skip e
-        return items
-
-    def _decode_dict(self): #d<>e
-        self.index += 1  #skip d
-        dictionary = {}
-        while chr(self.data[self.index]) != 'e':
-            key = self._decode_next()
-            value = self._decode_next() #keys = bytes in bencode
-            if isinstance(key, bytes):
-                key = key.decode('utf-8', errors='ignore')
-            dictionary[key] = value
-        self.index += 1  #skip e
-        return dictionary
+        data = self.data
+        raw = self.raw
+        size = len(data)
+        stack = [] #open containers
+        starts = [] #start offset of each open container
+        keys = [] #pending dict key for each open container (None = waiting for key)
+        index = self.index
+
+        while True:
+            if index >= size:
+                raise ValueError("Unexpected end of data")
+
+            token = data[index]
+
+            if token == _END: #close container
+                if not stack:
+                    raise ValueError("Unexpected end marker")
+                value = stack.pop()
+                start = starts.pop()
+                if keys.pop() is not None:
+                    raise ValueError("Dictionary key without value")
+                index += 1
+                #top level 'info' dict -> record its raw span
+                if (isinstance(value, dict) and len(stack) == 1
+                        and isinstance(stack[0], dict) and keys[0] == 'info'):
+                    self.info_span = (start, index)
+
+            elif token == _LIST or token == _DICT:
+                stack.append([] if token == _LIST else {})
+                starts.append(index)
+                keys.append(None)
+                index += 1
+                continue
+
+            elif token == _INT: #i<>e
+                end = raw.find(b'e', index + 1)
+                if end < 0:
+                    raise ValueError("Unterminated integer")
+                value = int(raw[index + 1:end])
+                index = end + 1
+
+            elif _ZERO <= token <= _NINE: #n:<>
+                colon = raw.find(b':', index)
+                if colon < 0:
+                    raise ValueError("Unterminated string length")
+                length = int(raw[index:colon])
+                index = colon + 1 + length
+                if index > size:
+                    raise ValueError("Unexpected end of data")
+                value = raw[colon + 1:index]
+
+            else:
+                raise ValueError(f"Unknown bencode type: {chr(token)}")
+
+            if not stack: #finished top level value
+                self.index = index
+                return value
+
+            parent = stack[-1]
+            if isinstance(parent, list):
+                parent.append(value)
+            elif keys[-1] is None: #keys = bytes in bencode
+                if isinstance(value, (bytes, bytearray)):
+                    value = value.decode('utf-8', errors='ignore')
+                elif isinstance(value, (list, dict)):
+                    raise ValueError("Dictionary key must be a string")
+                keys[-1] = value
+            else:
+                parent[keys[-1]] = value
+                keys[-1] = None
 
 
 class BencodeEncoder:
+    '''
+    linear time encoder: every value is turned into a stream of chunks,
+    which are appended to one bytearray or written straight to a file/socket
+    big strings (like 'pieces') are passed through without copying
+    '''
+    CHUNK_SIZE = 65536 #flush threshold for encode_to
+
     @staticmethod
     def encode(data):
-        if isinstance(data, int):
-            return f"i{data}e".encode()
-        elif isinstance(data, bytes):
-            return f"{len(data)}:".encode() + data
-        elif isinstance(data, str):
-            return BencodeEncoder.encode(data.encode())
-        elif isinstance(data, list):
-            result = b'l'
-            for item in data:
-                result += BencodeEncoder.encode(item)
-            result += b'e'
-            return result
-        elif isinstance(data, dict):
-            result = b'd'
-
-
-            for key in sorted(data.keys()): #sorting
-                result += BencodeEncoder.encode(key)
-                result += BencodeEncoder.encode(data[key])
-            result += b'e'
-            return result
-        else:
-            raise TypeError(f"Unsupported type: {type(data)}")
+        buffer = bytearray()
+        BencodeEncoder.encode_into(data, buffer)
+        return bytes(buffer)
+
+    @staticmethod
+    def encode_into(data, buffer): #append to existing bytearray, returns bytes written
+        start = len(buffer)
+        for chunk in BencodeEncoder.iter_encode(data):
+            buffer += chunk
+        return len(buffer) - start
+
+    @staticmethod
+    def encode_to(data, sink):
+        '''
+        stream encoded data to a file (write) or socket (sendall)
+        small chunks are batched, large ones are written directly
+        Returns:
+            int: number of bytes written
+        '''
+        write = getattr(sink, 'sendall', None) or sink.write
+        chunk_size = BencodeEncoder.CHUNK_SIZE
+        pending = bytearray()
+        written = 0
+
+        for chunk in BencodeEncoder.iter_encode(data):
+            if len(chunk) >= chunk_size: #don't copy big blobs into the batch
+                if pending:
+                    write(pending)
+                    written += len(pending)
+                    pending = bytearray()
+                write(chunk)
+                written += len(chunk)
+                continue
+            pending += chunk
+            if len(pending) >= chunk_size:
+                write(pending)
+                written += len(pending)
+                pending = bytearray()
+
+        if pending:
+            write(pending)
+            written += len(pending)
+        return written
+
+    @staticmethod
+    def encoded_length(data): #size of encoded data without building it
+        return sum(len(chunk) for chunk in BencodeEncoder.iter_encode(data))
+
+    @staticmethod
+    def iter_encode(data):
+        stack = [iter((data,))] #iterators of open containers, no recursion
+        while stack:
+            item = next(stack[-1], _DONE)
+            if item is _DONE:
+                stack.pop()
+                if stack: #root iterator has no end marker
+                    yield b'e'
+                continue
+
+            if isinstance(item, int):
+                yield b'i%de' % item
+            elif isinstance(item, (bytes, bytearray)):
+                yield b'%d:' % len(item)
+                yield item
+            elif isinstance(item, memoryview):
+                item = item.cast('B') if item.ndim != 1 or item.itemsize != 1 else item
+                yield b'%d:' % len(item)
+                yield item
+            elif isinstance(item, str):
+                item = item.encode()
+                yield b'%d:' % len(item)
+                yield item
+            elif isinstance(item, (list, tuple)):
+                yield b'l'
+                stack.append(iter(item))
+            elif isinstance(item, dict):
+                yield b'd'
+                stack.append(_iter_dict(item))
+            else:
+                raise TypeError(f"Unsupported type: {type(item)}")
+
+
+_DONE = object() #end of container marker for iter_encode
+
+
+def _iter_dict(dictionary): #keys sorted as raw bytes, then key, value, key, value...
+    items = []
+    for key, value in dictionary.items():
+        if isinstance(key, str):
+            key = key.encode()
+        elif not isinstance(key, bytes):
+            raise TypeError(f"Unsupported key type: {type(key)}")
+        items.append((key, value))
+    items.sort(key=lambda item: item[0]) #sorting
+
+    for key, value in items:
+        yield key
+        yield value
@@ -0,0 +1,134 @@
+"""
+piece bitfield in wire format (one bit per piece, most significant bit first)
+Used for our own pieces and for every peer's pieces, so loading a peer's
+BITFIELD and sending ours are plain byte copies
+"""
+
+import re
+
+#set bit positions for every byte value, for iterating pieces
+_BITS = tuple(tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256))
+_NONZERO = re.compile(rb'[^\x00]') #skips empty bytes in C, sparse bitfields iterate fast
+
+
+class Bitfield:
+    __slots__ = ('size', '_bits', '_count')
+
+    def __init__(self, size):
+        self.size = size
+        self._bits = bytearray((size + 7) // 8)
+        self._count = 0 #set bits, kept up to date by set/clear
+
+    @classmethod
+    def from_bytes(cls, size, payload):
+        """
+        load a BITFIELD payload
+        Args:
+            size: number of pieces, None = take it from payload length
+            payload: wire bytes
+        """
+        if size is None:
+            size = len(payload) * 8
+        bitfield = cls(size)
+        length = len(bitfield._bits)
+        if len(payload) < length:
+            raise ValueError(f"Bitfield too short: {len(payload)} bytes for {size} pieces")
+        bitfield._bits[:] = payload[:length]
+        if size % 8 and length: #spare bits at the end must be zero
+            bitfield._bits[-1] &= (0xFF << (8 - size % 8)) & 0xFF
+        bitfield._count = int.from_bytes(bitfield._bits, 'big').bit_count()
+        return bitfield
+
+    @classmethod
+    def full(cls, size): #every piece set, e.g. a seed
+        bitfield = cls(size)
+        bitfield.set_all()
+        return bitfield
+
+    def to_bytes(self): #wire format
+        return bytes(self._bits)
+
+    def resize(self, size): #grow when the real piece count was not known
+        if size > self.size:
+            self._bits.extend(bytes((size + 7) // 8 - len(self._bits)))
+            self.size = size
+
+    def set(self, index):
+        byte_index, mask = index >> 3, 0x80 >> (index & 7)
+        if not 0 <= index < self.size:
+            raise IndexError("piece index out of range")
+        if not self._bits[byte_index] & mask:
+            self._bits[byte_index] |= mask
+            self._count += 1
+
+    def clear(self, index):
+        byte_index, mask = index >> 3, 0x80 >> (index & 7)
+        if not 0 <= index < self.size:
+            raise IndexError("piece index out of range")
+        if self._bits[byte_index] & mask:
+            self._bits[byte_index] &= ~mask & 0xFF
+            self._count -= 1
+
+    def set_all(self):
+        self._bits[:] = b'\xff' * len(self._bits)
+        if self.size % 8:
+            self._bits[-1] = (0xFF << (8 - self.size % 8)) & 0xFF
+        self._count = self.size
+
+    def __contains__(self, index):
+        return 0 <= index < self.size and bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __getitem__(self, index): #bool like the old have_pieces list
+        if not 0 <= index < self.size:
+            raise IndexError("piece index out of range")
+        return bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index, value):
+        if value:
+            self.set(index)
+        else:
+            self.clear(index)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self): #indices of set pieces
+        bits = self._bits
+        for match in _NONZERO.finditer(bits):
+            byte_index = match.start()
+            base = byte_index << 3
+            for bit in _BITS[bits[byte_index]]:
+                yield base + bit
+
+    @property
+    def count(self): #popcount
+        return self._count
+
+    def all(self):
+        return self._count == self.size
+
+    def any(self):
+        return self._count > 0
+
+    def _and_not(self, mine): #self AND NOT mine as an int, sizes may differ
+        length = len(self._bits)
+        other = mine._bits if len(mine._bits) == length else bytes(mine._bits[:length]).ljust(length, b'\x00')
+        return int.from_bytes(self._bits, 'big') & ~int.from_bytes(other, 'big')
+
+    def interesting(self, mine):
+        """
+        pieces in self that mine lacks (self AND NOT mine), e.g. peer_pieces.interesting(have_pieces)
+        Returns:
+            Bitfield
+        """
+        value = self._and_not(mine)
+        result = Bitfield(self.size)
+        result._bits[:] = value.to_bytes(len(self._bits), 'big')
+        result._count = value.bit_count()
+        return result
+
+    def has_interesting(self, mine): #same check without building a Bitfield
+        return bool(self._and_not(mine))
+
+    def __repr__(self):
+        return f"Bitfield({self._count}/{self.size})"
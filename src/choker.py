@@ -0,0 +1,87 @@
+"""
+choking: who gets our upload slots
+Every round (INTERVAL seconds) the interested peers that give us the most
+(download rate from them, or upload rate to them once we are a seed) get the
+regular slots, tit-for-tat. One more optimistic slot rotates every few rounds
+to a random choked peer, so new peers get a chance to show their rate
+"""
+
+import random
+import time
+
+
+class Choker:
+    INTERVAL = 10 #seconds between rounds
+    SLOTS = 4 #regular unchoke slots
+    OPTIMISTIC_ROUNDS = 3 #optimistic slot moves every 30 s
+    NEW_PEER_TIME = 60 #peers younger than this are 3x as likely to get the optimistic slot
+
+    def __init__(self, slots=SLOTS):
+        self.slots = slots
+        self.rounds = 0
+        self.optimistic = None
+        self.first_seen = {} #peer -> monotonic time
+
+    def _seen(self, peer, now):
+        return self.first_seen.setdefault(peer, now)
+
+    def rechoke(self, peers, seeding=False):
+        """
+        one choking round over the connected peers
+        Args:
+            seeding: rank by our upload rate to the peer instead of its rate to us
+        Returns:
+            set of unchoked peers
+        """
+        now = time.monotonic()
+        self.rounds += 1
+        peers = [peer for peer in peers if peer.connected]
+        for peer in peers:
+            self._seen(peer, now)
+        interested = [peer for peer in peers if peer.peer_interested]
+
+        if seeding:
+            ranked = sorted(interested, key=lambda peer: peer.upload_rate.rate(now), reverse=True)
+        else:
+            ranked = sorted(interested, key=lambda peer: peer.download_rate.rate(now), reverse=True)
+        unchoked = set(ranked[:self.slots])
+
+        rotate = self.rounds % self.OPTIMISTIC_ROUNDS == 0
+        if rotate or self.optimistic not in interested or self.optimistic in unchoked: #gone, or earned a regular slot
+            self.optimistic = self._pick_optimistic([peer for peer in interested if peer not in unchoked], now)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer in peers:
+            try:
+                if peer in unchoked and peer.am_choking:
+                    peer.send_unchoke()
+                elif peer not in unchoked and not peer.am_choking:
+                    peer.send_choke()
+            except Exception: #dying connection, its worker drops it
+                pass
+        return unchoked
+
+    def _pick_optimistic(self, candidates, now):
+        if not candidates:
+            return None
+        weights = [3 if now - self._seen(peer, now) < self.NEW_PEER_TIME else 1 for peer in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def peer_interested(self, peer, peers):
+        """
+        INTERESTED between rounds: unchoke right away while a slot is free
+        """
+        if not peer.am_choking:
+            return
+        self._seen(peer, time.monotonic())
+        if sum(not other.am_choking for other in peers) < self.slots + 1:
+            try:
+                peer.send_unchoke()
+            except Exception:
+                pass
+
+    def forget(self, peer):
+        self.first_seen.pop(peer, None)
+        if self.optimistic is peer:
+            self.optimistic = None
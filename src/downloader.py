@@ -1,53 +1,225 @@
 import struct
+import time
 from .piece_manager import PieceManager
+from .pipeline import RequestPipeline
+from .uploader import Uploader
+from .choker import Choker
+from .shaper import TorrentLimits
 
 
 class Downloader:
-    MAX_INFLIGHT_PER_PEER = 10
+    CHOKE_TIMEOUT = 60 #how long a choked peer gets to unchoke us again
+    IDLE_POLL = 0.25 #async workers with nothing to request look again after this
     
-    def __init__(self, torrent, peers):
+    def __init__(self, torrent, peers, piece_manager=None, seed=False, limits=None):
         self.torrent = torrent
         self.peers = peers
-        self.piece_manager = PieceManager(torrent)
-        self.peer_inflight = {peer: 0 for peer in peers} #dict for peer requests
+        self.piece_manager = piece_manager or PieceManager(torrent)
+        self.uploader = Uploader(self.piece_manager)
+        self.choker = Choker() #call rechoke() every Choker.INTERVAL
+        self.seed = seed #async workers keep serving peers once there is nothing left to download
+        self.limits = limits or TorrentLimits() #rate limits, under the global ones
+        self.pipelines = {} #peer -> RequestPipeline
+        self.live_peers = set() #peers with a running worker, they get our HAVEs
+        self.piece_manager.have_listeners.append(self._broadcast_have)
+        for peer in peers: #bitfields already received during connect
+            self.add_peer(peer)
+
+    def add_peer(self, peer):
+        self.piece_manager.add_peer(peer)
+        self.live_peers.add(peer)
+        if peer.shaper is None:
+            peer.shaper = self.limits.shaper()
+
+    def pipeline(self, peer): #request depth for this peer, adapts to its bandwidth and latency
+        pipeline = self.pipelines.get(peer)
+        if pipeline is None:
+            pipeline = self.pipelines[peer] = RequestPipeline(self.piece_manager.BLOCK_SIZE, peer.peer_reqq)
+        return pipeline
+
+    def drop_peer(self, peer): #peer is gone, its pieces no longer count as available
+        self.piece_manager.remove_peer(peer)
+        self.pipelines.pop(peer, None)
+        self.live_peers.discard(peer)
+        self.choker.forget(peer)
+
+    def rechoke(self): #one choking round, tit-for-tat while downloading, upload rate as a seed
+        return self.choker.rechoke(list(self.live_peers), seeding=self.piece_manager.have_pieces.all())
+
+    def _broadcast_have(self, piece_index): #runs on a hashing thread
+        for peer in list(self.live_peers):
+            if not peer.has_piece(piece_index):
+                try:
+                    peer.send_have(piece_index)
+                except Exception:
+                    pass
+
+    def download_from_peer(self, peer, keep_going=lambda: True):
+        """
+        worker loop for one peer: keeps its request pipeline full with blocks
+        from the piece manager (any started piece, then new rarest pieces, then endgame),
+        returns when the peer fails or nothing is left to download
+        """
+        piece_manager = self.piece_manager
+        pipeline = self.pipeline(peer)
+        try:
+            while keep_going():
+                if peer.peer_choking: #wait for UNCHOKE, allowed fast pieces can still be requested
+                    if peer.allowed_fast:
+                        self._fill_pipeline(peer, pipeline, allowed=peer.allowed_fast)
+                    if not self._receive(peer, timeout=self.CHOKE_TIMEOUT):
+                        break
+                    continue
+
+                self._fill_pipeline(peer, pipeline)
+
+                if piece_manager.inflight(peer) == 0: #nothing this peer can help with right now
+                    if not piece_manager.wait_for_work(timeout=1):
+                        break
+                    continue
+
+                if not self._receive(peer, timeout=piece_manager.BLOCK_TIMEOUT):
+                    if piece_manager.inflight(peer) == 0: #endgame requests got cancelled
+                        continue
+                    break
+        finally:
+            self.drop_peer(peer)
+
+    async def download_from_peer_async(self, peer, keep_going=lambda: True):
+        """
+        download_from_peer for an AsyncPeerConnection, runs as a task on the
+        event loop, so any number of peers need no threads
+        """
+        piece_manager = self.piece_manager
+        pipeline = self.pipeline(peer)
+        try:
+            while keep_going() and peer.connected:
+                if peer.peer_choking:
+                    if peer.allowed_fast:
+                        self._fill_pipeline(peer, pipeline, allowed=peer.allowed_fast)
+                    if not await self._receive_async(peer, timeout=self.CHOKE_TIMEOUT):
+                        break
+                    continue
+
+                self._fill_pipeline(peer, pipeline)
+
+                if piece_manager.inflight(peer) == 0:
+                    if not piece_manager.wait_for_work(timeout=0): #only checks, never blocks the loop
+                        if not self.seed or (piece_manager.have_pieces.all() and peer.peer_pieces.all()):
+                            break #done, or both sides are seeds
+                    #idle: still answer the peer's requests while waiting
+                    if not await self._receive_async(peer, timeout=self.IDLE_POLL) and not peer.connected:
+                        break
+                    continue
+
+                await peer.drain()
+                if not await self._receive_async(peer, timeout=piece_manager.BLOCK_TIMEOUT):
+                    if piece_manager.inflight(peer) == 0:
+                        continue
+                    break
+        finally:
+            self.drop_peer(peer)
+
+    def _fill_pipeline(self, peer, pipeline, allowed=None): #top up outstanding requests to the pipeline depth
+        free = pipeline.depth - self.piece_manager.inflight(peer)
+        if free > 0:
+            with peer.batch(): #whole burst goes out in one write
+                for piece_index, begin, length in self.piece_manager.next_blocks(peer, free, allowed, tuple(peer.suggested)):
+                    peer.request_piece(piece_index, begin, length) #sending request
+                    peer.suggested.discard(piece_index) #started, no longer a hint
     
     def download_piece(self, peer, piece_index):
-        blocks = self.piece_manager.init_piece_download(piece_index) #16KB
-        total_blocks = len(blocks)
+        piece_manager = self.piece_manager
+        block_queue = piece_manager.init_piece_download(piece_index) #16KB
+        pipeline = self.pipeline(peer)
         requested = 0
-        received = 0
-        block_queue = list(blocks)
         
-        while received < total_blocks:
-            while requested < total_blocks and self.peer_inflight[peer] < self.MAX_INFLIGHT_PER_PEER:
-                block_offset, block_length = block_queue[requested]
-                peer.request_piece(piece_index, block_offset, block_length) #sending request
-                self.peer_inflight[peer] += 1
-                requested += 1
-            
-            msg = peer.receive_message(timeout=15) #vazno
+        while piece_manager.is_pending(piece_index): #done when all blocks are in (from any peer)
+            if peer.peer_choking:
+                return self._fail_piece(peer, piece_index)
+            with peer.batch():
+                while requested < len(block_queue) and piece_manager.inflight(peer) < pipeline.depth:
+                    block_offset, block_length = block_queue[requested]
+                    peer.request_piece(piece_index, block_offset, block_length) #sending request
+                    piece_manager.request_sent(peer, piece_index, block_offset)
+                    requested += 1
             
-            if msg is None:
-                return False
-            
-            msg_type, payload = msg
-            
-            if msg_type == 7: #PIECE
-                index = struct.unpack(">I", payload[0:4])[0] #index(4)
-                begin = struct.unpack(">I", payload[4:8])[0] #begin(4)
-                block_data = payload[8:] #variable
-                
-                if index != piece_index:
-                    continue
-                
-                self.piece_manager.add_block(piece_index, begin, block_data) #add to piecemanager
-                self.peer_inflight[peer] -= 1
-                received += 1
-                
-            elif msg_type == 0:
-                return False
+            if not self._receive(peer, timeout=15): #vazno
+                return self._fail_piece(peer, piece_index)
         
-        return self.piece_manager.have_pieces[piece_index]
+        return True #all blocks in, hashing continues in the verifier pool
+
+    def _receive(self, peer, timeout):
+        """
+        read and handle one message
+        Returns:
+            bool: False if peer timed out or the connection broke
+        """
+        try:
+            msg = peer.receive_message(timeout=timeout)
+        except Exception:
+            return False
+        return self._handle_message(peer, msg)
+
+    async def _receive_async(self, peer, timeout):
+        try:
+            msg = await peer.receive_message(timeout=timeout)
+        except Exception:
+            return False
+        if msg is not None and msg[0] == 6: #REQUEST, read from disk off the event loop
+            await self.uploader.handle_request_async(peer, msg[1])
+            return True
+        return self._handle_message(peer, msg)
+
+    def _handle_message(self, peer, msg):
+        if msg is None:
+            return False
+        
+        msg_type, payload = msg
+        
+        if msg_type == 7: #PIECE, copied into the piece buffer if this peer was asked for it
+            index, begin = struct.unpack_from(">II", payload) #index(4), begin(4)
+            sent = self.piece_manager.receive_block(peer, index, begin, memoryview(payload)[8:])
+            if sent is not None:
+                self._block_timing(peer, time.monotonic() - sent)
+            
+        elif msg_type == 4: #HAVE, peer_pieces already updated
+            self.piece_manager.peer_have(peer, struct.unpack(">I", payload[0:4])[0])
+
+        elif msg_type in (5, 14, 15): #late BITFIELD / HAVE_ALL / HAVE_NONE, replaces the peer's earlier counts
+            self.piece_manager.add_peer(peer)
+
+        elif msg_type == 0: #CHOKE
+            if not peer.supports_fast: #peer drops our queued requests, fast peers REJECT them one by one
+                self.piece_manager.release_requests(peer)
+            self.pipeline(peer).on_choke()
+
+        elif msg_type == 16: #REJECT_REQUEST, block goes to someone else right away
+            index, begin = struct.unpack_from(">II", payload)
+            self.piece_manager.request_rejected(peer, index, begin)
+
+        elif msg_type == 20: #EXTENDED, the handshake may bring the peer's request queue limit
+            if peer.peer_reqq:
+                self.pipeline(peer).set_limit(peer.peer_reqq)
+
+        elif msg_type == 2: #INTERESTED, gets a free slot now, otherwise waits for the next round
+            self.choker.peer_interested(peer, list(self.live_peers))
+
+        elif msg_type == 6: #REQUEST, upload from disk
+            self.uploader.handle_request(peer, payload)
+
+        return True
+
+    def _block_timing(self, peer, rtt):
+        pipeline = self.pipeline(peer)
+        if rtt > self.piece_manager.BLOCK_TIMEOUT: #request had already expired
+            pipeline.on_timeout()
+        else:
+            pipeline.on_block(rtt, peer.download_rate.rate())
+
+    def _fail_piece(self, peer, piece_index): #release piece for other peers
+        self.piece_manager.abort_piece(piece_index)
+        return False
     
     def download_pieces(self, num_pieces=5):
         pieces_downloaded = 0
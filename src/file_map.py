@@ -0,0 +1,59 @@
+"""
+maps pieces and blocks to the files they cover
+Built once from the cumulative file offsets in TorrentMeta,
+every lookup is a bisect plus the handful of files the range touches
+"""
+
+from bisect import bisect_right
+from typing import NamedTuple
+
+
+class FileSpan(NamedTuple):
+    file_index: int #index into meta.files
+    file_offset: int #where the span starts inside that file
+    length: int
+
+
+class FileMap:
+    def __init__(self, meta):
+        self.meta = meta
+        #empty files cover no bytes, leave them out of the lookup table
+        self._indices = [i for i, f in enumerate(meta.files) if f.length > 0]
+        self._starts = [meta.files[i].offset for i in self._indices]
+        self._ends = [meta.files[i].offset + meta.files[i].length for i in self._indices]
+
+    def spans(self, piece_index, begin=0, length=None):
+        """
+        (piece, begin, length) -> list of FileSpan in stream order
+        length defaults to the rest of the piece
+        """
+        if length is None:
+            length = self.meta.piece_size(piece_index) - begin
+        return self.stream_spans(piece_index * self.meta.piece_length + begin, length)
+
+    def stream_spans(self, offset, length): #same, for an offset in the whole torrent byte stream
+        end = offset + length
+        if offset < 0 or end > self.meta.total_size:
+            raise ValueError(f"Range {offset}+{length} outside torrent data")
+
+        spans = []
+        position = max(0, bisect_right(self._starts, offset) - 1) #last file starting at or before offset
+        while offset < end and position < len(self._starts):
+            file_start = self._starts[position]
+            stop = min(end, self._ends[position])
+            if stop > offset:
+                spans.append(FileSpan(self._indices[position], offset - file_start, stop - offset))
+                offset = stop
+            position += 1
+        return spans
+
+    def piece_files(self, piece_index): #indices of non empty files the piece touches
+        return [span.file_index for span in self.spans(piece_index)]
+
+    def file_pieces(self, file_index): #range of pieces holding the file's bytes
+        file_entry = self.meta.files[file_index]
+        if file_entry.length == 0:
+            return range(0)
+        first = file_entry.offset // self.meta.piece_length
+        last = (file_entry.offset + file_entry.length - 1) // self.meta.piece_length
+        return range(first, last + 1)
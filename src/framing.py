@@ -0,0 +1,113 @@
+"""
+buffers for peer wire framing
+Receive: one big reusable bytearray, the socket reads as much as it has into the
+free tail with a single recv_into, complete messages are handed out as memoryviews
+into it, a partial message stays for the next read (moved to the front first)
+Send: messages are packed into one buffer and go out in a single write
+"""
+
+import struct
+
+
+class MessageBuffer:
+    DEFAULT_SIZE = 1 << 18 #256 KB, ~16 blocks per recv
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 #first unread byte
+        self.end = 0 #end of received data
+
+    @property
+    def available(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        """
+        make room so size bytes from start fit in the buffer
+        (messages handed out earlier are no longer valid after this)
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if size > len(self.buffer): #bigger than the buffer, e.g. a huge bitfield
+            grown = bytearray(max(size, len(self.buffer) * 2))
+            grown[:self.available] = self.view[self.start:self.end]
+            self.buffer, self.view = grown, memoryview(grown) #old views keep the old buffer alive
+            self.start, self.end = 0, self.end - self.start
+        elif self.start + size > len(self.buffer) or self.end == len(self.buffer):
+            length = self.available
+            self.buffer[:length] = self.view[self.start:self.end] #carry the partial message over
+            self.start, self.end = 0, length
+
+    def free_view(self): #where the next recv_into writes
+        if self.end == len(self.buffer):
+            self.reserve(self.available)
+        return self.view[self.end:]
+
+    def produced(self, count):
+        self.end += count
+
+    def peek_length(self): #length prefix of the next message, None if not all 4 bytes are in
+        if self.available < 4:
+            return None
+        return struct.unpack_from(">I", self.buffer, self.start)[0]
+
+    def take(self, count): #consume count bytes, view valid until the next reserve/free_view
+        data = self.view[self.start:self.start + count]
+        self.start += count
+        return data
+
+
+class SendBuffer:
+    """
+    outgoing messages packed back to back into one preallocated bytearray,
+    the connection sends it with one write and keeps whatever the socket
+    didn't take (partial write) for the next flush
+    """
+    DEFAULT_SIZE = 1 << 14
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.buffer = bytearray(size)
+        self.start = 0 #first unsent byte
+        self.end = 0
+
+    def __len__(self): #bytes waiting
+        return self.end - self.start
+
+    def _room(self, size): #space for size more bytes at the end
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.end + size > len(self.buffer):
+            pending = self.buffer[self.start:self.end]
+            if len(pending) + size > len(self.buffer):
+                self.buffer = bytearray(max(len(self.buffer) * 2, len(pending) + size))
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+
+    def add(self, message_type, payload=b''): #length prefix, id, payload
+        size = 5 + len(payload)
+        self._room(size)
+        _HEADER.pack_into(self.buffer, self.end, 1 + len(payload), message_type)
+        self.buffer[self.end + 5:self.end + size] = payload
+        self.end += size
+
+    def pack(self, packer, *values): #fixed size message from a precompiled struct.Struct
+        self._room(packer.size)
+        packer.pack_into(self.buffer, self.end, *values)
+        self.end += packer.size
+
+    def write(self, data): #raw bytes, e.g. the rest of a block the socket didn't take
+        self._room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def pending(self): #unsent bytes, only valid until the next add/pack
+        return memoryview(self.buffer)[self.start:self.end]
+
+    def sent(self, count):
+        self.start += count
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+_HEADER = struct.Struct(">IB")
@@ -0,0 +1,67 @@
+"""
+SHA1 piece verification off the peer threads
+hashlib releases the GIL on big buffers, so a thread pool hashes
+pieces on all cores while peer threads keep reading their sockets
+"""
+
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PieceVerifier:
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or min(32, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hasher")
+        self.max_pending = max_pending or self.workers * 4 #queued + hashing pieces before busy()
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def busy(self): #hashing fell behind, callers hold off starting new pieces
+        return self.pending >= self.max_pending
+
+    def submit(self, data, expected_hash, callback):
+        """
+        hash data in the pool, then callback(ok) runs on the hashing thread
+        never blocks (peers on the event loop call this), backpressure is busy()
+        Returns:
+            Future
+        """
+        with self._lock:
+            self.pending += 1
+        try:
+            return self.executor.submit(self._verify, data, expected_hash, callback)
+        except RuntimeError: #pool shut down
+            self._done()
+            raise
+
+    def _verify(self, data, expected_hash, callback):
+        try:
+            ok = hashlib.sha1(data).digest() == expected_hash
+            try:
+                callback(ok)
+            except Exception as e: #nobody looks at the future, don't let it vanish
+                print(f"Piece callback failed: {e}")
+            return ok
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_verifier(): #one pool for all torrents in the process
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = PieceVerifier()
+        return _shared
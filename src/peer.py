@@ -8,8 +8,14 @@ Also handles bitfield to get pieces from other peers
 
 import socket
 import struct
+import threading
 import time
+from contextlib import contextmanager
 from enum import IntEnum
+from .bencode import BencodeDecoder, BencodeEncoder
+from .bitfield import Bitfield
+from .framing import MessageBuffer, SendBuffer
+from .stats import RateMeter
 
 class MessageType(IntEnum):
     CHOKE = 0
@@ -21,28 +27,73 @@ class MessageType(IntEnum):
     REQUEST = 6
     PIECE = 7
     CANCEL = 8
+    #BEP 6 fast extension
+    SUGGEST_PIECE = 13
+    HAVE_ALL = 14
+    HAVE_NONE = 15
+    REJECT_REQUEST = 16
+    ALLOWED_FAST = 17
+    EXTENDED = 20 #BEP 10, payload starts with the extended message id (0 = handshake)
+
+
+#reserved handshake bits we set and look for
+FAST_BIT = (7, 0x04) #BEP 6
+EXTENDED_BIT = (5, 0x10) #BEP 10
+CLIENT_NAME = "MiniTorrent 0.1"
+MAX_SUGGESTED = 32 #SUGGEST_PIECE hints kept per peer
+
+#longest message we accept, checked before buffering so a peer can't make us allocate
+#whatever its length prefix says
+MAX_MESSAGE = (1 << 14) + 13 #PIECE with a 16 KiB block, everything else is shorter
+MAX_EXTENDED = 1 << 16 #BEP 10 messages, the handshake is a few hundred bytes
+MAX_BITFIELD = 1 << 18 #bitfield bytes when the piece count isn't known (2M pieces)
+
+
+#fixed size messages packed straight into the send buffer: length, id, fields
+_HAVE = struct.Struct(">IBI")
+_REQUEST = struct.Struct(">IBIII") #also CANCEL and REJECT_REQUEST
+_PIECE = struct.Struct(">IBII") #header only, the block follows
+
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg') #not on windows
 
 
 class PeerConnection:
-    def __init__(self, ip, port, info_hash, peer_id):
+    SEND_TIMEOUT = 5 #a flush that can't write for this long leaves the rest queued
+    def __init__(self, ip, port, info_hash, peer_id, piece_count=None):
         self.ip = ip
         self.port = port
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.socket = None
         self.connected = False
+        self.send_lock = threading.Lock()
+        self.outbox = SendBuffer() #queued messages, sent by flush
+        self.corked = 0 #inside batch(), messages wait for the flush at the end
 
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
+        self.was_unchoked = False #peer unchoked us at least once on this connection
         self.peer_interested = False
-        self.peer_pieces = set()  #which peer has piece
+        self.piece_count = piece_count #None = guess from bitfield length
+        self.peer_pieces = Bitfield(piece_count or 0)  #which peer has piece
+        self.download_rate = RateMeter() #block bytes from this peer
+        self.upload_rate = RateMeter() #block bytes to this peer
+        self.inbox = None #MessageBuffer of received bytes not handed out yet, made on connect
+        self.supports_fast = False #both sides set the BEP 6 bit
+        self.supports_extended = False #both sides set the BEP 10 bit
+        self.peer_reqq = None #outstanding requests the peer accepts (extended handshake)
+        self.client = None #peer's client name (extended handshake 'v')
+        self.allowed_fast = set() #pieces we may request while choked
+        self.suggested = set() #pieces the peer suggests (has them cached)
+        self.shaper = None #PeerShaper with the rate limits, None = unlimited
 
     def connect(self, timeout=5): #TCP peer connection
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(timeout)
             self.socket.connect((self.ip, self.port))
+            self.inbox = MessageBuffer()
             self.connected = True
             return True
         except (socket.timeout, ConnectionRefusedError, OSError) as e:
@@ -53,22 +104,29 @@ class PeerConnection:
         if not self.connected:
             raise Exception("Not connected to peer")
 
+        self.socket.sendall(self._handshake_message())
+        self._check_handshake(self._recv_exactly(68))
+        if self.supports_extended:
+            self.send_extended_handshake()
+        return True
+
+    def _handshake_message(self):
         pstr = b"BitTorrent protocol"
         pstrlen = 19
-        reserved = b'\x00' * 8
+        reserved = bytearray(8)
+        for byte_index, bit in (FAST_BIT, EXTENDED_BIT):
+            reserved[byte_index] |= bit
 
-        handshake_msg = (
+        return (
                 struct.pack("B", pstrlen) +
                 pstr +
-                reserved +
+                bytes(reserved) +
                 self.info_hash +
                 self.peer_id
         )
 
-        self.socket.send(handshake_msg)
-
-        response = self._recv_exactly(68)
-
+    def _check_handshake(self, response):
+        pstr = b"BitTorrent protocol"
         if len(response) < 68:
             raise Exception("Invalid handshake response length")
 
@@ -85,19 +143,37 @@ class PeerConnection:
         if recv_info_hash != self.info_hash:
             raise Exception("Info hash mismatch")
 
+        self.supports_fast = bool(recv_reserved[FAST_BIT[0]] & FAST_BIT[1])
+        self.supports_extended = bool(recv_reserved[EXTENDED_BIT[0]] & EXTENDED_BIT[1])
+
         return True
 
-    def _recv_exactly(self, n): #receive exactly n bytes from TCP-socket
-        data = b'' #byte buffer
-        while len(data) < n:
-            try:
-                chunk = self.socket.recv(n - len(data))
-                if not chunk:
-                    raise Exception("Connection closed by peer")
-                data += chunk
-            except socket.timeout:
+    def _recv_exactly(self, n): #receive exactly n bytes from TCP-socket (through the buffer)
+        self.inbox.reserve(n)
+        while self.inbox.available < n:
+            if not self._fill():
                 raise Exception("timed out")
-        return data
+        return bytes(self.inbox.take(n))
+
+    def _fill(self, deadline=None):
+        """
+        one recv_into the free part of the receive buffer, as much as the socket has
+        Returns:
+            bool: False on timeout
+        """
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.socket.settimeout(remaining)
+        try:
+            count = self.socket.recv_into(self.inbox.free_view())
+        except socket.timeout:
+            return False
+        if not count:
+            raise Exception("Connection closed by peer")
+        self.inbox.produced(count)
+        return True
 
     def send_interested(self):
         self._send_message(MessageType.INTERESTED)
@@ -116,57 +192,234 @@ class PeerConnection:
         self.am_choking = True
 
     def _send_message(self, message_type, payload=b''):
-        length = 1 + len(payload)
-        message = struct.pack(">I", length) + struct.pack("B", message_type) + payload
-        self.socket.send(message)
-
-    def receive_message(self, timeout=5):
-        self.socket.settimeout(timeout)
-
+        with self.send_lock: #CANCEL can come from another peer's thread
+            self.outbox.add(message_type, payload)
+            if not self.corked:
+                self._flush()
+
+    def _send_packed(self, packer, *values): #same for fixed size messages, no temporary bytes
+        with self.send_lock:
+            self.outbox.pack(packer, *values)
+            if not self.corked:
+                self._flush()
+
+    @contextmanager
+    def batch(self):
+        """
+        queue every message sent inside, then write them all at once
+        e.g. a burst of REQUESTs becomes one send and one TCP segment
+        """
+        with self.send_lock:
+            self.corked += 1
         try:
-            length_data = self._recv_exactly(4)
-            length = struct.unpack(">I", length_data)[0]
-
-            if length == 0:
-                return (None, b'')
-
-            message_id = self._recv_exactly(1)[0] #takes 1st byte
-
-            payload = b''
-            if length > 1:
-                payload = self._recv_exactly(length - 1) #without id
-
-            if message_id == MessageType.CHOKE:
-                self.peer_choking = True
-            elif message_id == MessageType.UNCHOKE:
-                self.peer_choking = False
-            elif message_id == MessageType.INTERESTED:
-                self.peer_interested = True
-            elif message_id == MessageType.NOT_INTERESTED:
-                self.peer_interested = False
-            elif message_id == MessageType.BITFIELD:
-                self._handle_bitfield(payload)
+            yield self
+        finally:
+            with self.send_lock:
+                self.corked -= 1
+                if not self.corked:
+                    self._flush()
+
+    def flush(self):
+        with self.send_lock:
+            return self._flush()
+
+    def _flush(self, tail=None):
+        """
+        send the queued messages, call with send_lock held
+        tail: block to send right after them, scatter-gather so it is never copied
+        Returns:
+            bool: False if the socket didn't take everything in time, the rest stays queued
+        """
+        outbox = self.outbox
+        if tail is not None and not _HAS_SENDMSG:
+            outbox.write(tail)
+            tail = None
+        if not len(outbox) and not tail:
+            return True
+        self.socket.settimeout(self.SEND_TIMEOUT) #receive deadlines may have left a short one
+        while len(outbox) or tail:
+            try:
+                if tail:
+                    sent = self.socket.sendmsg([outbox.pending(), tail])
+                else:
+                    sent = self.socket.send(outbox.pending())
+            except socket.timeout:
+                if tail:
+                    outbox.write(tail) #keep the order, rest of the block waits with the queue
+                return False
+            queued = len(outbox)
+            outbox.sent(min(sent, queued)) #partial write: only drop what the kernel took
+            if tail and sent > queued:
+                tail = tail[sent - queued:]
+        return True
 
-            return (message_id, payload)
+    def receive_message(self, timeout=5):
+        """
+        next message from the receive buffer, reads the socket only when no
+        complete message is buffered (one recv usually brings several)
+        Returns:
+            (message_id, payload) with payload a memoryview valid until the next call,
+            None on timeout (nothing is lost, the next call continues the message)
+        """
+        if self.shaper is not None: #over a rate limit: hold off reading, TCP slows the peer down
+            wait = self.shaper.delay()
+            if wait:
+                time.sleep(wait)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            message = self._next_message()
+            if message is not None:
+                return message
+            if not self._fill(deadline):
+                return None
+
+    def _next_message(self): #complete message from the buffer or None
+        inbox = self.inbox
+        length = inbox.peek_length()
+        if length is None:
+            inbox.reserve(4)
+            return None
+        if length == 0: #keep-alive
+            inbox.take(4)
+            return (None, b'')
+        if inbox.available < 5: #id decides how long the message may be
+            inbox.reserve(5)
+            return None
+        self._check_length(length, inbox.buffer[inbox.start + 4])
 
-        except socket.timeout:
+        if inbox.available - 4 < length: #PIECE blocks too: the piece manager copies them in under its lock
+            inbox.reserve(4 + length)
             return None
 
+        message = inbox.take(4 + length)
+        message_id = message[4]
+        payload = message[5:]
+        self._update_state(message_id, payload)
+        return (message_id, payload)
+
+    def _check_length(self, length, message_id):
+        """
+        close the connection if the message is longer than its type allows
+        length: from the length prefix, includes the id byte
+        """
+        if message_id == MessageType.BITFIELD:
+            limit = 1 + ((self.piece_count + 7) // 8 if self.piece_count else MAX_BITFIELD)
+        elif message_id == MessageType.EXTENDED:
+            limit = MAX_EXTENDED
+        else:
+            limit = MAX_MESSAGE
+        if length > limit:
+            self.close()
+            raise Exception(f"Message too long: {length} bytes (id {message_id})")
+
+    def _update_state(self, message_id, payload): #choke/interest flags and peer pieces
+        if message_id == MessageType.PIECE:
+            self._block_received(max(0, len(payload) - 8))
+        elif message_id == MessageType.CHOKE:
+            self.peer_choking = True
+        elif message_id == MessageType.UNCHOKE:
+            self.peer_choking = False
+            self.was_unchoked = True
+        elif message_id == MessageType.INTERESTED:
+            self.peer_interested = True
+        elif message_id == MessageType.NOT_INTERESTED:
+            self.peer_interested = False
+        elif message_id == MessageType.HAVE:
+            self._handle_have(struct.unpack(">I", payload[:4])[0])
+        elif message_id == MessageType.BITFIELD:
+            self._handle_bitfield(payload)
+        elif message_id == MessageType.HAVE_ALL: #seed, no bitfield to parse
+            self.peer_pieces = Bitfield.full(self.piece_count or 0)
+        elif message_id == MessageType.HAVE_NONE:
+            self.peer_pieces = Bitfield(self.piece_count or 0)
+        elif message_id == MessageType.ALLOWED_FAST:
+            piece_index = struct.unpack(">I", payload[:4])[0]
+            if self.piece_count is None or piece_index < self.piece_count:
+                self.allowed_fast.add(piece_index)
+        elif message_id == MessageType.SUGGEST_PIECE:
+            piece_index = struct.unpack(">I", payload[:4])[0]
+            if len(self.suggested) < MAX_SUGGESTED and (self.piece_count is None or piece_index < self.piece_count):
+                self.suggested.add(piece_index)
+        elif message_id == MessageType.EXTENDED and len(payload) > 1 and payload[0] == 0:
+            self._handle_extended_handshake(payload[1:])
+
+    def _block_received(self, length):
+        self.download_rate.add(length)
+        if self.shaper is not None:
+            self.shaper.downloaded(length)
+
+    def _handle_extended_handshake(self, payload):
+        try:
+            info = BencodeDecoder(bytes(payload)).decode()
+        except ValueError:
+            return
+        if not isinstance(info, dict):
+            return
+        reqq = info.get('reqq')
+        if isinstance(reqq, int) and reqq > 0:
+            self.peer_reqq = reqq
+        client = info.get('v')
+        if isinstance(client, bytes):
+            self.client = client.decode('utf-8', errors='replace')
+
     def _handle_bitfield(self, bitfield): #bitfield, what pieces peer has
-        self.peer_pieces = set()
+        self.peer_pieces = Bitfield.from_bytes(self.piece_count, bitfield) #bulk copy, no per bit loop
 
-        for byte_index, byte in enumerate(bitfield):
-            for bit_index in range(8):
-                if byte & (1 << (7 - bit_index)): #Most significant byte
-                    piece_index = byte_index * 8 + bit_index
-                    self.peer_pieces.add(piece_index)
+    def _handle_have(self, piece_index):
+        if self.piece_count is None:
+            self.peer_pieces.resize(piece_index + 1)
+        if piece_index < self.peer_pieces.size:
+            self.peer_pieces.set(piece_index)
 
     def has_piece(self, piece_index):
         return piece_index in self.peer_pieces
 
+    def send_block(self, piece_index, begin, block):
+        """
+        PIECE message, block (e.g. an mmap slice) goes out straight
+        from its memory, not through the send buffer
+        """
+        with self.send_lock:
+            self.outbox.pack(_PIECE, 9 + len(block), MessageType.PIECE, piece_index, begin)
+            if self.corked:
+                self.outbox.write(block)
+            else:
+                self._flush(block)
+        self.upload_rate.add(len(block))
+        if self.shaper is not None:
+            self.shaper.uploaded(len(block))
+
+    def send_have(self, piece_index):
+        self._send_packed(_HAVE, 5, MessageType.HAVE, piece_index)
+
+    def send_bitfield(self, bitfield): #our pieces, already in wire format
+        self._send_message(MessageType.BITFIELD, bitfield.to_bytes())
+
+    def send_pieces(self, have_pieces):
+        """
+        first message after the handshake: HAVE_ALL / HAVE_NONE for fast
+        extension peers (a seed sends 5 bytes instead of a bitfield), else BITFIELD
+        """
+        if self.supports_fast and have_pieces.all():
+            self._send_message(MessageType.HAVE_ALL)
+        elif self.supports_fast and not have_pieces.any():
+            self._send_message(MessageType.HAVE_NONE)
+        elif have_pieces.any():
+            self.send_bitfield(have_pieces)
+
+    def send_reject(self, piece_index, begin, length): #fast extension: we won't serve this request
+        self._send_packed(_REQUEST, 13, MessageType.REJECT_REQUEST, piece_index, begin, length)
+
+    def send_extended_handshake(self, reqq=500):
+        info = {'m': {}, 'v': CLIENT_NAME, 'reqq': reqq}
+        self._send_message(MessageType.EXTENDED, b'\x00' + BencodeEncoder.encode(info))
+
     def request_piece(self, piece_index, begin, length):
-        payload = struct.pack(">III", piece_index, begin, length)
-        self._send_message(MessageType.REQUEST, payload)
+        self._send_packed(_REQUEST, 13, MessageType.REQUEST, piece_index, begin, length)
+
+    def send_cancel(self, piece_index, begin, length):
+        self._send_packed(_REQUEST, 13, MessageType.CANCEL, piece_index, begin, length)
 
     def close(self):
         if self.socket:
@@ -0,0 +1,157 @@
+"""
+persistent peer pool for one torrent
+Every address the tracker ever gave us is a candidate. The pool keeps up to
+target connections alive: whenever one dies (or a refill tick finds free slots)
+it connects the next candidates, best first. Addresses that fail wait before the
+next try, twice as long after every failure in a row, and are forgotten after
+too many. Re-announces keep feeding new addresses in
+"""
+
+import asyncio
+import time
+
+
+class Candidate:
+    __slots__ = ('address', 'failures', 'next_try')
+
+    def __init__(self, address):
+        self.address = address
+        self.failures = 0 #in a row, reset by a connection that worked
+        self.next_try = 0.0 #monotonic time of the next connection attempt
+
+
+class PeerPool:
+    RETRY_DELAY = 5 #seconds before the first retry of a failed address
+    MAX_RETRY_DELAY = 600
+    MAX_FAILURES = 8 #forgotten after this many failures in a row
+
+    def __init__(self, connect, run, target=50, max_connecting=10):
+        """
+        Args:
+            connect: async (ip, port) -> connected peer or None
+            run: async (peer) -> returns when the peer is done (its worker)
+            target: live connections to keep
+            max_connecting: connection attempts in flight at once
+        """
+        self.connect = connect
+        self.run = run
+        self.target = target
+        self.max_connecting = max_connecting
+        self.candidates = {} #(ip, port) -> Candidate
+        self.live = {} #(ip, port) -> peer
+        self.connecting = set() #addresses with an attempt in flight
+        self.tasks = set() #connect + worker tasks
+        self.closed = False
+
+    def add(self, addresses):
+        """
+        new candidates from the tracker, known ones keep their backoff
+        Returns:
+            int: how many were new
+        """
+        added = 0
+        for address in addresses:
+            address = (address[0], int(address[1]))
+            if address not in self.candidates:
+                self.candidates[address] = Candidate(address)
+                added += 1
+        return added
+
+    def _ready(self, now): #candidates that may be tried now, fewest failures first
+        ready = [candidate for address, candidate in self.candidates.items()
+                 if address not in self.live and address not in self.connecting and candidate.next_try <= now]
+        ready.sort(key=lambda candidate: (candidate.failures, candidate.next_try))
+        return ready
+
+    def free_slots(self):
+        return self.target - len(self.live) - len(self.connecting)
+
+    def starving(self): #free slots and no candidate left to try, time to ask the tracker
+        if self.free_slots() <= 0:
+            return False
+        now = time.monotonic()
+        return not any(address not in self.live and address not in self.connecting and candidate.next_try <= now
+                       for address, candidate in self.candidates.items())
+
+    def refill(self):
+        """
+        start connection attempts for the free slots
+        Returns:
+            int: attempts started
+        """
+        if self.closed:
+            return 0
+        count = min(self.free_slots(), self.max_connecting - len(self.connecting))
+        if count <= 0:
+            return 0
+        started = 0
+        for candidate in self._ready(time.monotonic())[:count]:
+            self.connecting.add(candidate.address)
+            self._spawn(self._connect(candidate))
+            started += 1
+        return started
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _connect(self, candidate):
+        address = candidate.address
+        try:
+            peer = await self.connect(*address)
+        except Exception:
+            peer = None
+        finally:
+            self.connecting.discard(address)
+
+        if peer is None:
+            self._failed(candidate)
+            self.refill() #next candidate takes the slot
+            return
+        if self.closed:
+            peer.close()
+            return
+        self.live[address] = peer
+        await self._run(candidate, peer)
+
+    async def _run(self, candidate, peer):
+        try:
+            await self.run(peer)
+        except Exception as e:
+            print(f"Peer {peer.ip}:{peer.port} failed: {e}")
+        finally:
+            self.live.pop(candidate.address, None)
+            peer.close()
+
+        if self.closed:
+            return
+        #moved no data and never unchoked us: backs off like a failed connect however long
+        #it stayed, or a silent peer dropped after CHOKE_TIMEOUT comes back every RETRY_DELAY
+        if peer.download_rate.total or peer.upload_rate.total or peer.was_unchoked:
+            candidate.failures = 0 #worked, may come back after the short delay
+            candidate.next_try = time.monotonic() + self.RETRY_DELAY
+        else:
+            self._failed(candidate)
+        self.refill() #replace it right away
+
+    def _failed(self, candidate):
+        candidate.failures += 1
+        if candidate.failures >= self.MAX_FAILURES:
+            self.candidates.pop(candidate.address, None)
+            return
+        delay = min(self.MAX_RETRY_DELAY, self.RETRY_DELAY * 2 ** (candidate.failures - 1))
+        candidate.next_try = time.monotonic() + delay
+
+    def peers(self):
+        return list(self.live.values())
+
+    async def close(self):
+        """
+        stop refilling, close every connection and wait for the workers
+        """
+        self.closed = True
+        for peer in list(self.live.values()): #wakes workers still waiting on a read
+            peer.close()
+        tasks = list(self.tasks)
+        await asyncio.gather(*tasks, return_exceptions=True)
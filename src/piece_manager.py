@@ -1,147 +1,545 @@
 
-import hashlib
+import heapq
+import threading
+import time
+from collections import deque
 from pathlib import Path
+from .storage import FileStorage
+from .file_map import FileMap
+from .piece_picker import PiecePicker
+from .bitfield import Bitfield
+from .hasher import shared_verifier
+from .resume import ResumeFile, recheck_pieces
+from .stats import TransferStats
+
+
+class PieceBuffer:
+    '''
+    one in flight piece: a preallocated buffer that blocks are copied into
+    (under the manager lock), the same buffer is then hashed and written to disk
+    '''
+    __slots__ = ('data', 'view', 'blocks', 'missing', 'free', 'queued')
+
+    def __init__(self, piece_length, block_size):
+        self.data = bytearray(piece_length)
+        self.view = memoryview(self.data)
+        self.blocks = {} #offset -> (length, received)
+        for offset in range(0, piece_length, block_size):
+            self.blocks[offset] = (min(block_size, piece_length - offset), False)
+        self.missing = len(self.blocks)
+        self.free = deque(self.blocks) #offsets nobody is asked for, stale ones are skipped when taken
+        self.queued = set(self.blocks) #offsets in free
+
+    def release(self, begin): #block needs a (new) owner again, goes first. True if queued
+        block = self.blocks.get(begin)
+        if block is None or block[1] or begin in self.queued:
+            return False
+        self.queued.add(begin)
+        self.free.appendleft(begin)
+        return True
+
+    def block_view(self, begin, length): #where a block goes, None if not expected (call with the manager lock held)
+        block = self.blocks.get(begin)
+        if block is None or block[0] != length or block[1]:
+            return None
+        return self.view[begin:begin + length]
+
+    def mark(self, begin): #True if this block was new
+        block = self.blocks.get(begin)
+        if block is None or block[1]:
+            return False
+        self.blocks[begin] = (block[0], True)
+        self.missing -= 1
+        return True
+
+
+SEED = object() #peer_counts entry of a peer counted as a seed
 
 
 class PieceManager:
     BLOCK_SIZE = 16384
-    def __init__(self, torrent, download_dir="downloads"): #PATH TO DOWNLOAD
+    BLOCK_TIMEOUT = 15 #seconds before a requested block can be handed to another peer
+    def __init__(self, torrent, download_dir="downloads", verifier=None, resume_dir=".cache/resume"): #PATH TO DOWNLOAD
         self.torrent = torrent
+        self.meta = torrent.meta #precomputed sizes and hashes
         self.download_dir = Path(download_dir)
         self.download_dir.mkdir(exist_ok=True)
 
-        self.have_pieces = [False] * len(torrent.pieces)
-        self.piece_data = {} #bytes of pieces
+        self.have_pieces = Bitfield(self.meta.piece_count)
+        self.file_map = FileMap(self.meta) #piece/block -> file spans
+        self.storage = FileStorage(self.meta, self.download_dir, self.file_map) #verified pieces go straight to disk
+        self.file_missing = [len(self.file_map.file_pieces(i)) for i in range(len(self.meta.files))] #pieces left per file
+        self.downloaded_bytes = 0 #verified bytes written
+        self.stats = TransferStats() #updated per block/piece, speeds are rolling windows
         self.pending_blocks = {}
-    
-    def get_next_piece_to_download(self, peer): #checks
-        for piece_index in range(len(self.torrent.pieces)):
-            if self.have_pieces[piece_index]:
+        self.requests = {} #(piece, begin) -> {peer: time requested}, who owns which block
+        self.peer_requests = {} #peer -> {(piece, begin)} outstanding
+        self.open_pieces = {} #pending pieces with queued free blocks, oldest first (dict as ordered set)
+        self.deadlines = [] #heap of (time, piece, begin): when a request may go to another peer
+        self.picker = PiecePicker(self.meta.piece_count) #rarest first, skips done and in flight pieces
+        self.peer_counts = {} #peer -> Bitfield of its pieces counted in the picker, SEED for seeds
+        self.lock = threading.Lock() #picker is shared by all peer threads
+        self.verifier = verifier or shared_verifier() #SHA1 runs in the hashing pool
+        self.verifying = 0 #pieces handed to the verifier, not finished yet
+        self.error = None #message of a failed disk write, the download can't go on
+        self.changed = threading.Condition(self.lock) #piece verified or put back
+        self.resume = ResumeFile(torrent.info_hash, resume_dir)
+        self.have_listeners = [] #callable(piece_index) after a piece is verified and on disk
+        self.restore_state() #pieces already on disk from an earlier run
+
+    def add_peer(self, peer):
+        """
+        count peer's pieces in availability, a later bitfield (late BITFIELD,
+        HAVE_ALL...) replaces what was counted for the peer before
+        """
+        peer_pieces = peer.peer_pieces
+        if peer_pieces.size == self.meta.piece_count and peer_pieces.all():
+            pieces = SEED #one counter in the picker instead of every piece
+        else:
+            pieces = Bitfield.from_bytes(peer_pieces.size, peer_pieces.to_bytes()) #what we counted, for removal
+        with self.lock:
+            self._uncount(peer)
+            self.peer_counts[peer] = pieces
+            if pieces is SEED:
+                self.picker.add_seed()
+            else:
+                self.picker.add_peer(pieces)
+
+    def _uncount(self, peer): #call with self.lock held
+        counted = self.peer_counts.pop(peer, None)
+        if counted is SEED:
+            self.picker.remove_seed()
+        elif counted is not None:
+            self.picker.remove_peer(counted)
+
+    def remove_peer(self, peer): #also forgets its outstanding requests
+        with self.lock:
+            self._uncount(peer)
+            for key in self.peer_requests.pop(peer, ()):
+                self._forget_request(peer, key)
+
+    def peer_have(self, peer, piece_index): #HAVE message from a registered peer, counted once per piece
+        if not 0 <= piece_index < self.meta.piece_count:
+            return
+        with self.lock:
+            counted = self.peer_counts.get(peer)
+            if counted is None or counted is SEED or piece_index in counted:
+                return
+            counted.resize(piece_index + 1)
+            counted.set(piece_index)
+            self.picker.peer_have(piece_index)
+
+    def is_interesting(self, peer): #peer has something we don't
+        return peer.peer_pieces.has_interesting(self.have_pieces)
+
+    def get_next_piece_to_download(self, peer): #reserves the piece for this peer
+        if not self.is_interesting(peer):
+            return None
+        with self.lock:
+            piece_index = self.picker.pick(peer.has_piece, peer.peer_pieces)
+            if piece_index is not None:
+                self.picker.remove(piece_index)
+            return piece_index
+
+    def abort_piece(self, piece_index): #peer failed mid piece, let others take it
+        with self.lock:
+            if self.pending_blocks.pop(piece_index, None) is not None:
+                self.open_pieces.pop(piece_index, None)
+                self._restore_piece(piece_index)
+
+    def _restore_piece(self, piece_index): #call with self.lock held
+        if not self.have_pieces[piece_index]:
+            self.picker.restore(piece_index)
+        self.changed.notify_all()
+
+    def _forget_request(self, peer, key): #call with self.lock held, a block nobody is asked for is free again
+        peers = self.requests.get(key)
+        if peers is not None:
+            peers.pop(peer, None)
+            if not peers:
+                del self.requests[key]
+                self._release_block(*key)
+
+    def _add_request(self, peer, key, now): #call with self.lock held
+        self.requests.setdefault(key, {})[peer] = now
+        self.peer_requests.setdefault(peer, set()).add(key)
+        heapq.heappush(self.deadlines, (now + self.BLOCK_TIMEOUT, key[0], key[1]))
+
+    def _release_block(self, piece_index, begin): #call with self.lock held
+        piece_buffer = self.pending_blocks.get(piece_index)
+        if piece_buffer is not None and piece_buffer.release(begin):
+            self.open_pieces[piece_index] = None
+
+    def _expire_requests(self, now): #call with self.lock held, requests past their deadline free their block
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, piece_index, begin = heapq.heappop(deadlines)
+            owners = self.requests.get((piece_index, begin))
+            if owners and max(owners.values()) + self.BLOCK_TIMEOUT <= now: #nobody asked again since
+                self._release_block(piece_index, begin)
+
+    def request_sent(self, peer, piece_index, begin):
+        with self.lock:
+            self._add_request(peer, (piece_index, begin), time.monotonic())
+
+    def release_requests(self, peer): #peer choked or failed, its blocks are free again
+        with self.lock:
+            for key in self.peer_requests.pop(peer, ()):
+                self._forget_request(peer, key)
+            self.changed.notify_all()
+
+    def request_rejected(self, peer, piece_index, begin): #REJECT_REQUEST, block is free for anyone again
+        key = (piece_index, begin)
+        with self.lock:
+            outstanding = self.peer_requests.get(peer)
+            if outstanding is not None and key in outstanding:
+                outstanding.discard(key)
+                self._forget_request(peer, key)
+                self.changed.notify_all()
+
+    def inflight(self, peer): #outstanding requests of this peer
+        return len(self.peer_requests.get(peer, ()))
+
+    def is_pending(self, piece_index):
+        return piece_index in self.pending_blocks
+
+    def next_blocks(self, peer, limit, allowed=None, suggested=()):
+        """
+        block level scheduling, up to limit blocks for this peer to request:
+        1. free blocks of pieces already started (by any peer), from their queues
+        2. blocks of a new piece, the peer's suggestions first, then the rarest first picker
+           (not while the verifier is busy, the hashing backlog drains first)
+        3. endgame: blocks other peers are still downloading, first copy wins
+        a block is free when nobody asked for it, or every request is older than BLOCK_TIMEOUT,
+        outside the endgame a call costs about the blocks it returns
+        Args:
+            allowed: only these pieces (allowed fast pieces while choked)
+            suggested: pieces the peer suggested (SUGGEST_PIECE)
+        Returns:
+            list of (piece_index, begin, length), already registered as requested
+        """
+        now = time.monotonic()
+        expired = now - self.BLOCK_TIMEOUT
+        blocks = []
+        if allowed is None:
+            has_piece, pieces = peer.has_piece, peer.peer_pieces
+        else:
+            has_piece = lambda piece_index: piece_index in allowed and peer.has_piece(piece_index)
+            pieces = [piece_index for piece_index in allowed if peer.has_piece(piece_index)]
+        with self.lock:
+            asked = self.peer_requests.get(peer, ())
+            self._expire_requests(now)
+
+            drained = []
+            for piece_index in self.open_pieces:
+                if len(blocks) >= limit:
+                    break
+                if has_piece(piece_index) and self._take_free(piece_index, asked, expired, blocks, limit):
+                    drained.append(piece_index)
+            for piece_index in drained:
+                del self.open_pieces[piece_index]
+
+            starting = not self.verifier.busy()
+            for piece_index in suggested if starting else ():
+                if len(blocks) >= limit:
+                    break
+                if piece_index < self.meta.piece_count and self.picker.is_wanted(piece_index) and has_piece(piece_index):
+                    self._start_piece(piece_index)
+                    self._take_new(piece_index, asked, expired, blocks, limit)
+
+            while starting and len(blocks) < limit and self.picker.wanted:
+                piece_index = self.picker.pick(has_piece, pieces)
+                if piece_index is None:
+                    break
+                self._start_piece(piece_index)
+                self._take_new(piece_index, asked, expired, blocks, limit)
+
+            if not blocks and self.picker.wanted == 0: #endgame, only the last pieces are left to walk
+                for piece_index, piece_buffer in self.pending_blocks.items():
+                    if len(blocks) >= limit:
+                        break
+                    if has_piece(piece_index):
+                        self._endgame_blocks(piece_index, piece_buffer, asked, blocks, limit)
+
+            for piece_index, begin, _ in blocks:
+                self._add_request(peer, (piece_index, begin), now)
+        return blocks
+
+    def _start_piece(self, piece_index): #call with self.lock held
+        self.picker.remove(piece_index)
+        piece_buffer = PieceBuffer(self.get_piece_length(piece_index), self.BLOCK_SIZE)
+        self.pending_blocks[piece_index] = piece_buffer
+        self.open_pieces[piece_index] = None
+        return piece_buffer
+
+    def _take_new(self, piece_index, asked, expired, blocks, limit): #call with self.lock held
+        if self._take_free(piece_index, asked, expired, blocks, limit):
+            del self.open_pieces[piece_index]
+
+    def _take_free(self, piece_index, asked, expired, blocks, limit):
+        """
+        call with self.lock held, takes blocks off the piece's free queue,
+        entries that got an owner or arrived meanwhile are dropped on the way
+        Returns:
+            bool: True if the queue is empty now
+        """
+        piece_buffer = self.pending_blocks[piece_index]
+        free, queued = piece_buffer.free, piece_buffer.queued
+        mine = [] #expired requests of this peer itself, stay queued for the others
+        while free and len(blocks) < limit:
+            begin = free.popleft()
+            key = (piece_index, begin)
+            if key in asked:
+                mine.append(begin)
                 continue
-            if not peer.has_piece(piece_index):
+            queued.discard(begin)
+            length, received = piece_buffer.blocks[begin]
+            if received:
                 continue
-            if piece_index in self.pending_blocks:
+            owners = self.requests.get(key)
+            if owners and max(owners.values()) > expired: #asked meanwhile, its deadline frees it again
                 continue
-            return piece_index
-        return None
-    
+            blocks.append((piece_index, begin, length))
+        free.extendleft(reversed(mine))
+        return not free
+
+    def _endgame_blocks(self, piece_index, piece_buffer, asked, blocks, limit):
+        #call with self.lock held, blocks other peers are downloading too
+        for begin, (length, received) in piece_buffer.blocks.items():
+            if received or (piece_index, begin) in asked:
+                continue
+            blocks.append((piece_index, begin, length))
+            if len(blocks) >= limit:
+                return
+
+    def _take_duplicates(self, key, peer): #call with self.lock held, block is in: who else still waits for it
+        others = self.requests.pop(key, {})
+        others.pop(peer, None)
+        for other in others:
+            self.peer_requests.get(other, set()).discard(key)
+        return others
+
+    def _send_cancels(self, others, piece_index, begin, length): #outside the lock, sends can block
+        for other in others:
+            try:
+                other.send_cancel(piece_index, begin, length)
+            except Exception:
+                pass
+
     def init_piece_download(self, piece_index):
-        piece_length = self.get_piece_length(piece_index) #real length of piece
-        blocks = []
-        offset = 0
-        
-        while offset < piece_length: #creates blocks
-            block_length = min(self.BLOCK_SIZE, piece_length - offset) #if less 16KB, take the less
-            blocks.append((offset, block_length))
-            offset += block_length #offset, length
-        
-        self.pending_blocks[piece_index] = {offset: None for offset, _ in blocks} #dict for downloaded blocks
-        return blocks
+        piece_buffer = PieceBuffer(self.get_piece_length(piece_index), self.BLOCK_SIZE) #16KB blocks, last can be less
+        with self.lock:
+            self.picker.remove(piece_index)
+            self.pending_blocks[piece_index] = piece_buffer
+            self.open_pieces[piece_index] = None
+        return [(offset, block[0]) for offset, block in piece_buffer.blocks.items()] #offset, length
     
     def get_piece_length(self, piece_index):
-        if piece_index == len(self.torrent.pieces) - 1: #last piece
-            return self.torrent.total_size % self.torrent.piece_length or self.torrent.piece_length
-        else:
-            return self.torrent.piece_length
+        return self.meta.piece_size(piece_index) #last piece can be shorter
     
-    def add_block(self, piece_index, block_offset, block_data):
-        if piece_index not in self.pending_blocks:
+    def receive_block(self, peer, piece_index, begin, data):
+        """
+        PIECE from peer, copied into the piece buffer only if this peer has the
+        block outstanding (never requested, cancelled or already in = wasted)
+        Returns:
+            monotonic time the block was requested, None if it wasn't
+        """
+        key = (piece_index, begin)
+        sent = placed = None
+        with self.lock:
+            outstanding = self.peer_requests.get(peer)
+            if outstanding is not None and key in outstanding:
+                outstanding.discard(key)
+                sent = self.requests.get(key, {}).get(peer)
+                placed = self._place(piece_index, begin, data, peer) #drops every request of the block
+                if placed is None:
+                    self._forget_request(peer, key)
+        self._placed(piece_index, begin, len(data), placed)
+        return sent
+
+    def add_block(self, piece_index, block_offset, block_data, peer=None): #block without a request to check, e.g. from disk
+        with self.lock:
+            placed = self._place(piece_index, block_offset, block_data, peer)
+        return self._placed(piece_index, block_offset, len(block_data), placed)
+
+    def _place(self, piece_index, begin, data, peer): #call with self.lock held
+        """
+        copy and mark a block, a complete piece leaves pending_blocks right here so
+        nothing can write into the buffer once it is handed to the verifier
+        Returns:
+            (peers to CANCEL, complete PieceBuffer or None), None if the block wasn't needed
+        """
+        piece_buffer = self.pending_blocks.get(piece_index)
+        view = None if piece_buffer is None else piece_buffer.block_view(begin, len(data))
+        if view is None: #unknown piece, wrong size or already in
+            return None
+        view[:] = data
+        piece_buffer.mark(begin)
+        others = self._take_duplicates((piece_index, begin), peer)
+        if piece_buffer.missing:
+            return others, None
+        del self.pending_blocks[piece_index]
+        self.open_pieces.pop(piece_index, None)
+        self.verifying += 1
+        return others, piece_buffer
+
+    def _placed(self, piece_index, begin, length, placed): #outside the lock: stats, CANCELs, hashing
+        if placed is None:
+            self.stats.block_wasted(length)
             return False
-        
-        self.pending_blocks[piece_index][block_offset] = block_data
-        
-        if all(data is not None for data in self.pending_blocks[piece_index].values()):
-            return self._complete_piece(piece_index)
-        
-        return False
-    
-    def _complete_piece(self, piece_index):
-        blocks = self.pending_blocks[piece_index] #dict
-        sorted_offsets = sorted(blocks.keys()) #sort
-        piece_data = b''.join(blocks[offset] for offset in sorted_offsets) #assemble
-
-        #check hash
-        piece_hash = hashlib.sha1(piece_data).digest()
-        expected_hash = self.torrent.pieces[piece_index]
-        
-        if piece_hash != expected_hash:
-            print(f"Piece {piece_index} HASH MISMATCH")
-            del self.pending_blocks[piece_index]
+        others, piece_buffer = placed
+        self.stats.block_received(length)
+        self._send_cancels(others, piece_index, begin, length)
+        if piece_buffer is None:
             return False
+        self._verify_piece(piece_index, piece_buffer)
+        return True
+
+    def _verify_piece(self, piece_index, piece_buffer): #all blocks here, hash it in the pool
+        piece_data = piece_buffer.data #blocks already in order, no join
+        expected_hash = self.meta.piece_hashes[piece_index]
+        self.verifier.submit(piece_data, expected_hash,
+                             lambda ok: self._piece_verified(piece_index, piece_data, ok))
+
+    def _piece_verified(self, piece_index, piece_data, ok): #runs on a hashing thread
+        try:
+            if not ok:
+                print(f"Piece {piece_index} HASH MISMATCH")
+                self.stats.piece_failed(len(piece_data))
+                with self.lock:
+                    self._restore_piece(piece_index)
+                return
+
+            try:
+                self.storage.write_piece(piece_index, piece_data) #at its offset, nothing kept in RAM
+            except Exception as e: #disk full, I/O error: piece goes back, the torrent stops with an error
+                print(f"Piece {piece_index} write failed: {e}")
+                with self.lock:
+                    self.error = f"Write failed: {e}"
+                    self._restore_piece(piece_index)
+                return
+            self.stats.piece_verified(len(piece_data))
+            with self.lock:
+                self._mark_have(piece_index)
+
+            print(f"Piece {piece_index} completed and verified.")
+            for listener in self.have_listeners:
+                listener(piece_index)
+        finally:
+            with self.lock:
+                self.verifying -= 1
+                self.changed.notify_all()
+
+    def wait_verified(self, timeout=None): #until every queued piece is hashed and written
+        with self.lock:
+            return self.changed.wait_for(lambda: self.verifying == 0, timeout)
 
-        self.piece_data[piece_index] = piece_data
+    def wait_for_work(self, timeout=1):
+        """
+        nothing to pick right now: wait while other pieces are still in flight
+        or being hashed, one of them may fail and come back
+        Returns:
+            bool: False if there is nothing left that could come back
+        """
+        with self.lock:
+            if not self.pending_blocks and not self.verifying:
+                return False
+            self.changed.wait(timeout)
+            return True
+
+    def _mark_have(self, piece_index): #call with self.lock held
+        self.downloaded_bytes += self.meta.piece_size(piece_index)
         self.have_pieces[piece_index] = True
-        del self.pending_blocks[piece_index]
-        
-        print(f"Piece {piece_index} completed and verified.")
-        return True
-    
+        self.picker.remove(piece_index)
+        self._update_files(piece_index)
+
+    def restore_state(self):
+        """
+        seed have_pieces from the resume file, pieces of files changed since
+        it was written (or all existing files if there is no resume file)
+        are rechecked from disk in parallel
+        """
+        stats = self.storage.file_stats()
+        if not any(stats):
+            return #nothing on disk, fresh download
+
+        record = self.resume.load(self.meta.piece_count, len(self.meta.files))
+        trusted = record[0] if record else Bitfield(self.meta.piece_count)
+        saved_stats = record[1] if record else [None] * len(stats)
+        recheck = Bitfield(self.meta.piece_count)
+        unusable = Bitfield(self.meta.piece_count)
+
+        for file_index, file_entry in enumerate(self.meta.files):
+            pieces = self.file_map.file_pieces(file_index)
+            current = stats[file_index]
+            if current is None or current[0] != file_entry.length: #missing or wrong size, no data to trust
+                for piece_index in pieces:
+                    unusable.set(piece_index)
+            elif current != saved_stats[file_index]: #touched since resume was saved
+                for piece_index in pieces:
+                    recheck.set(piece_index)
+
+        have = trusted.interesting(recheck).interesting(unusable) #trusted AND NOT recheck AND NOT unusable
+        to_check = list(recheck.interesting(unusable))
+        if to_check:
+            print(f"Rechecking {len(to_check)} pieces of {self.meta.name}")
+            for piece_index in recheck_pieces(self.storage, to_check, self.verifier.workers):
+                have.set(piece_index)
+
+        with self.lock:
+            for piece_index in have:
+                self._mark_have(piece_index)
+        print(f"Resumed {self.meta.name}: {self.have_pieces.count}/{self.meta.piece_count} pieces on disk")
+
+    def save_resume(self):
+        with self.lock:
+            have_pieces = Bitfield.from_bytes(self.meta.piece_count, self.have_pieces.to_bytes())
+        try: #bitfield first, then stats: a later write only makes the file look stale
+            self.resume.save(have_pieces, self.storage.file_stats())
+        except OSError as e:
+            print(f"Resume save failed: {e}")
+
+    def _update_files(self, piece_index): #only the files this piece touches
+        for file_index in self.file_map.piece_files(piece_index):
+            self.file_missing[file_index] -= 1
+            if self.file_missing[file_index] == 0:
+                print(f"File completed: {'/'.join(self.meta.files[file_index].path)}")
+
+    def get_file_progress(self):
+        progress = []
+        for file_index, file_entry in enumerate(self.meta.files):
+            total = len(self.file_map.file_pieces(file_index))
+            progress.append({
+                'path': '/'.join(file_entry.path),
+                'length': file_entry.length,
+                'completed_pieces': total - self.file_missing[file_index],
+                'total_pieces': total,
+                'completed': self.file_missing[file_index] == 0,
+            })
+        return progress
+
     def get_progress(self):
-        completed = sum(self.have_pieces)
-        total = len(self.have_pieces)
+        completed = self.have_pieces.count
+        total = self.have_pieces.size
         percentage = (completed / total) * 100 if total > 0 else 0
         
         return {
             'completed_pieces': completed,
             'total_pieces': total,
             'percentage': percentage,
-            'downloaded_bytes': sum(len(self.piece_data[i]) for i in self.piece_data),
-            'total_bytes': self.torrent.total_size
+            'downloaded_bytes': self.downloaded_bytes,
+            'total_bytes': self.meta.total_size,
+            'received_bytes': self.stats.received,
+            'wasted_bytes': self.stats.wasted,
+            'failed_bytes': self.stats.failed,
+            'download_speed': self.stats.download_rate.rate(),
+            'upload_speed': self.stats.upload_rate.rate(),
         }
     
-    def save_to_disk(self):
-        if not any(self.have_pieces):
+    def save_to_disk(self): #pieces are already on disk, just flush and close files
+        self.wait_verified()
+        if not self.have_pieces.any():
             print("No pieces to save")
-            return
-
-        if self.torrent.is_multi_file:
-            self._save_multi_file()
-        else:
-            self._save_single_file()
-    
-    def _save_single_file(self):
-        output_path = self.download_dir / self.torrent.name
-
-        print(f"\nSaving to: {output_path}")
-        
-        with open(output_path, 'wb') as f:
-            for piece_index in range(len(self.torrent.pieces)):
-                if piece_index in self.piece_data:
-                    f.write(self.piece_data[piece_index])
-        
-        print(f"Saved {sum(self.have_pieces)} pieces to disk")
-    
-    def _save_multi_file(self):
-        base_dir = self.download_dir / self.torrent.name
-        base_dir.mkdir(exist_ok=True)
-        
-        print(f"\nSaving multi-file torrent to: {base_dir}")
-
-        all_data = bytearray() #assemble all data
-        for piece_index in range(len(self.torrent.pieces)):
-            if piece_index in self.piece_data:
-                all_data.extend(self.piece_data[piece_index])
-        
-        #get file list from torrent info
-        files = self.torrent.data['info'].get('files', [])
-        
-        if not files:
-            print("Warning: Multi-file torrent but no files list found")
-            return
-
-        offset = 0
-        for file_info in files:
-            path_parts = file_info['path']
-
-            if isinstance(path_parts[0], bytes): #if path in bytes
-                path_parts = [p.decode('utf-8') for p in path_parts] #decode the path into string
-            file_path = base_dir / Path(*path_parts) #full path
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            length = file_info['length']
-            file_data = all_data[offset:offset + length] #Berem нужную часть общего массива данных
-
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            print(f"Saved: {file_path.name} ({length} bytes)")
-            offset += length
-
+        self.storage.close()
+        self.save_resume()
+        print(f"Saved {self.have_pieces.count} pieces to: {self.download_dir / self.meta.name}")
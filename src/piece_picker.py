@@ -0,0 +1,129 @@
+"""
+rarest first piece picker
+Keeps how many peers have every piece (from bitfields and HAVE messages)
+and buckets wanted pieces by that count. Picking walks buckets from the rarest
+and starts at a random spot inside a bucket, so peers spread over the swarm
+instead of all asking for piece 0, 1, 2...
+A peer with few pieces would make that walk long, so once it has looked at as
+many pieces as the peer has, it goes through the peer's own pieces instead.
+Seeds only bump a counter: they add the same to every piece, so the buckets
+(and the rarest first order) stay as they are and a seed costs O(1)
+"""
+
+import random
+from .bitfield import Bitfield
+
+
+class PiecePicker:
+    def __init__(self, piece_count):
+        self.piece_count = piece_count
+        self.availability = [0] * piece_count #peers having each piece, seeds not included
+        self.seeds = 0 #peers with every piece, counted for all pieces at once
+        self.buckets = [list(range(piece_count))] #buckets[n] = wanted pieces n peers have
+        self.position = list(range(piece_count)) #index of piece inside its bucket, -1 = not wanted
+        self.wanted = piece_count
+
+    def _bucket_remove(self, piece_index):
+        bucket = self.buckets[self.availability[piece_index]]
+        position = self.position[piece_index]
+        last = bucket.pop() #swap remove, O(1)
+        if last != piece_index:
+            bucket[position] = last
+            self.position[last] = position
+        self.position[piece_index] = -1
+
+    def _bucket_add(self, piece_index):
+        count = self.availability[piece_index]
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.position[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def _change(self, piece_index, delta):
+        wanted = self.position[piece_index] >= 0
+        if wanted:
+            self._bucket_remove(piece_index)
+        self.availability[piece_index] = max(0, self.availability[piece_index] + delta)
+        if wanted:
+            self._bucket_add(piece_index)
+
+    def peer_have(self, piece_index): #HAVE message
+        if 0 <= piece_index < self.piece_count:
+            self._change(piece_index, 1)
+
+    def add_peer(self, pieces): #peer bitfield (iterable of piece indices)
+        for piece_index in pieces:
+            self.peer_have(piece_index)
+
+    def remove_peer(self, pieces): #peer gone, forget its pieces
+        for piece_index in pieces:
+            if 0 <= piece_index < self.piece_count:
+                self._change(piece_index, -1)
+
+    def add_seed(self): #full bitfield / HAVE_ALL
+        self.seeds += 1
+
+    def remove_seed(self):
+        self.seeds = max(0, self.seeds - 1)
+
+    def is_wanted(self, piece_index):
+        return self.position[piece_index] >= 0
+
+    def remove(self, piece_index): #in flight or complete, not offered anymore
+        if self.position[piece_index] >= 0:
+            self._bucket_remove(piece_index)
+            self.wanted -= 1
+
+    def restore(self, piece_index): #download failed, offer again
+        if self.position[piece_index] < 0:
+            self._bucket_add(piece_index)
+            self.wanted += 1
+
+    def pick(self, has_piece, pieces=None):
+        """
+        random piece among the rarest wanted pieces this peer has
+        Args:
+            has_piece: callable(piece_index) -> bool, usually peer.has_piece
+            pieces: the peer's pieces (Bitfield or list), bounds the work to
+                about their number when given
+        Returns:
+            int or None
+        """
+        if pieces is None:
+            budget = self.wanted
+        else:
+            budget = pieces.count if isinstance(pieces, Bitfield) else len(pieces)
+        looked = 0
+        for count in range(0 if self.seeds else 1, len(self.buckets)): #bucket 0: only seeds have it
+            bucket = self.buckets[count]
+            size = len(bucket)
+            if not size:
+                continue
+            if looked + size > budget and pieces is not None: #cheaper to go through the peer's pieces
+                return self._pick_among(pieces, has_piece)
+            looked += size
+            start = random.randrange(size)
+            for i in range(size):
+                piece_index = bucket[(start + i) % size]
+                if has_piece(piece_index):
+                    return piece_index
+        return None
+
+    def _pick_among(self, pieces, has_piece): #rarest wanted piece of pieces, random among equals
+        best = None
+        best_count = 0
+        ties = 0
+        for piece_index in pieces:
+            if not 0 <= piece_index < self.piece_count or self.position[piece_index] < 0:
+                continue
+            count = self.availability[piece_index]
+            if (count == 0 and not self.seeds) or (best is not None and count > best_count) or not has_piece(piece_index):
+                continue
+            if best is None or count < best_count:
+                best, best_count, ties = piece_index, count, 1
+            else: #same rarity, keep each with equal chance
+                ties += 1
+                if random.randrange(ties) == 0:
+                    best = piece_index
+        return best
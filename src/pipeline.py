@@ -0,0 +1,53 @@
+"""
+adaptive request pipeline depth per peer
+Depth grows while blocks come back about as fast as the lowest RTT we saw
+(link not full yet), once requests start queueing it is set to the
+bandwidth-delay product (rate * min RTT) with headroom. Choke/timeouts shrink it
+"""
+
+import math
+
+
+class RequestPipeline:
+    MIN_DEPTH = 2
+    MAX_DEPTH = 500 #~8 MB of 16 KB requests in flight
+    INITIAL_DEPTH = 10
+    HEADROOM = 2 #keep twice the BDP in flight
+    QUEUEING = 2 #srtt above this many min RTTs = requests are queueing
+
+    def __init__(self, block_size=16384, max_depth=None):
+        self.block_size = block_size
+        self.max_depth = max_depth or self.MAX_DEPTH #peer's reqq can lower it
+        self.depth = min(self.INITIAL_DEPTH, self.max_depth)
+        self.min_rtt = None #lowest request -> block time seen, closest we get to the bare latency
+        self.srtt = None #smoothed request -> block time
+
+    def set_limit(self, max_depth): #e.g. peer advertised reqq
+        self.max_depth = max(self.MIN_DEPTH, min(self.MAX_DEPTH, max_depth))
+        self.depth = min(self.depth, self.max_depth)
+
+    def on_block(self, rtt, rate):
+        """
+        block arrived
+        Args:
+            rtt: seconds since it was requested
+            rate: current download rate from this peer, bytes/s
+        """
+        if rtt < 0:
+            return
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        self.srtt = rtt if self.srtt is None else self.srtt * 0.875 + rtt * 0.125
+
+        if self.srtt < self.QUEUEING * self.min_rtt: #not queueing yet, room to grow
+            depth = self.depth + 1
+        else: #link is full, size to bandwidth * delay
+            depth = math.ceil(rate * self.min_rtt * self.HEADROOM / self.block_size) + 1
+        self.depth = max(self.MIN_DEPTH, min(self.max_depth, depth))
+
+    def on_choke(self):
+        self.depth = max(self.MIN_DEPTH, self.depth // 2)
+
+    def on_timeout(self):
+        self.depth = self.MIN_DEPTH
+        self.srtt = None
@@ -0,0 +1,72 @@
+"""
+fast resume
+Per torrent resume file (bencoded): have-bitfield plus size and mtime of
+every file when it was written. Pieces are trusted only while their files
+still match, pieces of changed/unknown files are rechecked from disk in parallel
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from .bencode import BencodeDecoder, BencodeEncoder
+from .bitfield import Bitfield
+
+
+class ResumeFile:
+    def __init__(self, info_hash, resume_dir=".cache/resume"):
+        self.info_hash = info_hash
+        self.path = Path(resume_dir) / (info_hash.hex() + ".resume")
+
+    def load(self, piece_count, file_count):
+        """
+        Returns:
+            (Bitfield, list of (size, mtime_ns)) or None if missing/broken
+        """
+        try:
+            data = BencodeDecoder(self.path.read_bytes()).decode()
+            if data['info_hash'] != self.info_hash or len(data['files']) != file_count:
+                return None
+            have_pieces = Bitfield.from_bytes(piece_count, data['bitfield'])
+            files = [tuple(entry) if entry else None for entry in data['files']]
+            return have_pieces, files
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, have_pieces, file_stats):
+        record = {
+            'info_hash': self.info_hash,
+            'bitfield': have_pieces.to_bytes(),
+            'files': [list(stat) if stat else [] for stat in file_stats],
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            BencodeEncoder.encode_to(record, f)
+        os.replace(tmp_path, self.path) #no half written resume files
+
+    def delete(self):
+        self.path.unlink(missing_ok=True)
+
+
+def recheck_pieces(storage, pieces, workers=None):
+    """
+    hash existing data of the given pieces, reads and SHA1 run in parallel
+    (both release the GIL)
+    Returns:
+        list of piece indices that match their hash
+    """
+    meta = storage.meta
+    workers = workers or min(32, os.cpu_count() or 1)
+
+    def check(piece_index):
+        try:
+            data = storage.read_piece(piece_index)
+        except OSError:
+            return None
+        if hashlib.sha1(data).digest() == meta.piece_hashes[piece_index]:
+            return piece_index
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recheck") as executor:
+        return [i for i in executor.map(check, pieces) if i is not None]
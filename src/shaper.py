@@ -0,0 +1,143 @@
+"""
+bandwidth shaping with token buckets
+Every block a peer connection receives or sends is charged to three buckets:
+global, its torrent's and its own. A bucket that runs into debt tells the
+connection how long to wait, the connection holds off its next read for that
+long (TCP flow control then slows the sender, and our uploads wait for the
+peer's next REQUEST). Rate 0 = unlimited, costs one attribute check per block
+"""
+
+import threading
+import time
+import weakref
+
+
+class TokenBucket:
+    BURST = 1.0 #seconds of rate that can be saved up while idle
+
+    def __init__(self, rate=0):
+        self.rate = rate or 0 #bytes/s, 0 = unlimited
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self._lock = threading.Lock() #global bucket is shared by every peer
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = max(0, int(rate or 0))
+            self.tokens = min(self.tokens, self.rate * self.BURST) #no burst saved under the old rate
+            self.last = time.monotonic()
+
+    def consume(self, amount, now=None):
+        """
+        take amount bytes, going into debt if there aren't enough tokens
+        Returns:
+            float: seconds until the debt is paid back (0 = go on)
+        """
+        if not self.rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            rate = self.rate
+            if not rate: #unlimited meanwhile
+                return 0.0
+            self.tokens = min(rate * self.BURST, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= amount
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+
+class Limits:
+    """
+    download/upload bucket pair, rates in bytes/s (0 = unlimited)
+    """
+    def __init__(self, download=0, upload=0):
+        self.download = TokenBucket(download)
+        self.upload = TokenBucket(upload)
+
+    def set(self, download=None, upload=None): #None = leave as is
+        if download is not None:
+            self.download.set_rate(download)
+        if upload is not None:
+            self.upload.set_rate(upload)
+
+    def to_dict(self):
+        return {"download": self.download.rate, "upload": self.upload.rate}
+
+
+global_limits = Limits() #all torrents together
+
+
+class TorrentLimits(Limits):
+    """
+    one torrent's limits, plus the default per-peer limits every peer of the
+    torrent gets (changing them also changes the peers already connected)
+    """
+    def __init__(self, download=0, upload=0, peer_download=0, peer_upload=0, parent=None):
+        super().__init__(download, upload)
+        self.parent = parent or global_limits
+        self.peer_download = peer_download
+        self.peer_upload = peer_upload
+        self.shapers = weakref.WeakSet() #PeerShapers handed out, for runtime changes
+
+    def set(self, download=None, upload=None, peer_download=None, peer_upload=None):
+        super().set(download, upload)
+        if peer_download is not None:
+            self.peer_download = max(0, int(peer_download))
+        if peer_upload is not None:
+            self.peer_upload = max(0, int(peer_upload))
+        for shaper in list(self.shapers):
+            shaper.limits.set(peer_download, peer_upload)
+
+    def to_dict(self):
+        limits = super().to_dict()
+        limits.update(peer_download=self.peer_download, peer_upload=self.peer_upload)
+        return limits
+
+    def shaper(self):
+        """
+        new PeerShaper for a peer of this torrent: global -> torrent -> peer buckets
+        """
+        shaper = PeerShaper(self.parent, self, Limits(self.peer_download, self.peer_upload))
+        self.shapers.add(shaper)
+        return shaper
+
+
+class PeerShaper:
+    """
+    one peer connection's view of the buckets, set as PeerConnection.shaper
+    """
+    def __init__(self, *levels):
+        self.limits = levels[-1] #the peer's own pair
+        self.download = [limits.download for limits in levels]
+        self.upload = [limits.upload for limits in levels]
+        self.resume_at = 0.0 #monotonic time the next read may happen
+
+    def downloaded(self, amount):
+        self._charge(self.download, amount)
+
+    def uploaded(self, amount):
+        self._charge(self.upload, amount)
+
+    def _charge(self, buckets, amount):
+        now = None
+        wait = 0.0
+        for bucket in buckets:
+            if bucket.rate: #fast path: unlimited buckets are skipped without the lock
+                if now is None:
+                    now = time.monotonic()
+                wait = max(wait, bucket.consume(amount, now))
+        if wait:
+            self.resume_at = max(self.resume_at, now + wait)
+
+    def delay(self):
+        """
+        Returns:
+            float: seconds the connection should wait before reading again
+        """
+        if not self.resume_at:
+            return 0.0
+        wait = self.resume_at - time.monotonic()
+        if wait <= 0:
+            self.resume_at = 0.0
+            return 0.0
+        return wait
@@ -0,0 +1,84 @@
+"""
+transfer accounting
+Counters are bumped on every event (block in, hash pass/fail, wasted bytes),
+speeds come from a sliding window over a small ring buffer of time slots,
+so reading progress or speed is O(1) no matter how big the torrent is
+"""
+
+import threading
+import time
+
+
+class RateMeter:
+    def __init__(self, window=5.0, slots=20):
+        self.window = window
+        self.slot_time = window / slots
+        self.buckets = [0] * slots #bytes per time slot, ring buffer
+        self.started = time.monotonic()
+        self.current = int(self.started / self.slot_time) #absolute slot number of buckets[current % slots]
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def _advance(self, slot): #clear slots that passed with no traffic
+        slots = len(self.buckets)
+        if slot - self.current >= slots:
+            self.buckets = [0] * slots
+        else:
+            for passed in range(self.current + 1, slot + 1):
+                self.buckets[passed % slots] = 0
+        self.current = slot
+
+    def add(self, amount, now=None):
+        now = time.monotonic() if now is None else now
+        slot = int(now / self.slot_time)
+        with self._lock:
+            if slot > self.current:
+                self._advance(slot)
+            self.buckets[self.current % len(self.buckets)] += amount
+            self.total += amount
+
+    def rate(self, now=None): #bytes per second over the window
+        now = time.monotonic() if now is None else now
+        slot = int(now / self.slot_time)
+        with self._lock:
+            if slot > self.current:
+                self._advance(slot)
+            #full older slots plus the part of the current one, less at the very start
+            span = (len(self.buckets) - 1) * self.slot_time + (now - slot * self.slot_time)
+            span = min(span, now - self.started)
+            return sum(self.buckets) / span if span > 0 else 0.0
+
+
+class TransferStats:
+    def __init__(self):
+        self.received = 0 #payload bytes of new blocks
+        self.verified = 0 #bytes of pieces that passed SHA1
+        self.failed = 0 #bytes of pieces that failed SHA1
+        self.wasted = 0 #duplicate or unrequested block bytes
+        self.uploaded = 0
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        self._lock = threading.Lock()
+
+    def block_received(self, length):
+        with self._lock:
+            self.received += length
+        self.download_rate.add(length)
+
+    def block_wasted(self, length):
+        with self._lock:
+            self.wasted += length
+        self.download_rate.add(length) #still used the link
+
+    def piece_verified(self, length):
+        with self._lock:
+            self.verified += length
+
+    def piece_failed(self, length):
+        with self._lock:
+            self.failed += length
+
+    def block_uploaded(self, length):
+        with self._lock:
+            self.uploaded += length
+        self.upload_rate.add(length)
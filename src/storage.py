@@ -0,0 +1,150 @@
+"""
+disk storage for downloaded pieces
+Files are created at their final size up front and every verified piece
+is written at its offset right away, so nothing waits in RAM for 100%
+Blocks we upload are read through read-only mmaps of the same files
+"""
+
+import mmap
+import os
+import threading
+from pathlib import Path
+from .file_map import FileMap
+
+
+class FileStorage:
+    def __init__(self, meta, download_dir="downloads", file_map=None):
+        self.meta = meta
+        self.file_map = file_map or FileMap(meta)
+        self.download_dir = Path(download_dir)
+        self._fds = None #one fd per FileEntry, opened on first write
+        self._maps = {} #file index -> read-only mmap (None if it can't be mapped)
+        self._lock = threading.Lock()
+
+    def file_path(self, file_index): #full path
+        return self.download_dir / Path(*self.meta.files[file_index].path)
+
+    def file_stats(self):
+        """
+        (size, mtime_ns) of every file, None for files that don't exist yet
+        """
+        stats = []
+        for index in range(len(self.meta.files)):
+            try:
+                stat = os.stat(self.file_path(index))
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def open(self):
+        with self._lock:
+            if self._fds is not None:
+                return
+            fds = []
+            for index, file_entry in enumerate(self.meta.files):
+                file_path = self.file_path(index)
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+                if os.fstat(fd).st_size != file_entry.length:
+                    os.ftruncate(fd, file_entry.length) #sparse preallocation, keeps existing data
+                fds.append(fd)
+            self._fds = fds
+            print(f"Preallocated {len(fds)} file(s) in {self.download_dir}")
+
+    def write_piece(self, piece_index, data, begin=0): #whole piece or a block of it
+        view = memoryview(data)
+        if self._fds is None:
+            self.open()
+        position = 0
+        for span in self.file_map.spans(piece_index, begin, len(view)):
+            self._pwrite(self._fds[span.file_index], view[position:position + span.length], span.file_offset)
+            position += span.length
+
+    def read_piece(self, piece_index, begin=0, length=None): #bytes of a piece (or block) from disk
+        if self._fds is None:
+            self.open()
+        spans = self.file_map.spans(piece_index, begin, length)
+        data = bytearray(sum(span.length for span in spans))
+        view = memoryview(data)
+        position = 0
+        for span in spans:
+            done = 0
+            while done < span.length: #pread may return less than asked
+                chunk = _pread(self._fds[span.file_index], span.length - done, span.file_offset + done)
+                if not chunk:
+                    raise IOError(f"Short read in {self.file_path(span.file_index)}")
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+                done += len(chunk)
+        return data
+
+    def map_block(self, piece_index, begin, length):
+        """
+        block as a read-only memoryview of the mapped file (no read, no copy)
+        Returns:
+            memoryview, None if the block spans files or the file can't be mapped
+        """
+        spans = self.file_map.spans(piece_index, begin, length)
+        if len(spans) != 1:
+            return None
+        span = spans[0]
+        mapped = self._map(span.file_index)
+        if mapped is None:
+            return None
+        try:
+            return memoryview(mapped)[span.file_offset:span.file_offset + span.length]
+        except ValueError: #closed by close() on another thread
+            return None
+
+    def _map(self, file_index):
+        if self._fds is None:
+            self.open()
+        with self._lock:
+            if file_index not in self._maps:
+                try:
+                    self._maps[file_index] = mmap.mmap(self._fds[file_index], 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError): #e.g. 32 bit address space
+                    self._maps[file_index] = None
+            return self._maps[file_index]
+
+    def _pwrite(self, fd, view, position):
+        while view: #pwrite may write less than asked
+            written = _pwrite(fd, view, position)
+            view = view[written:]
+            position += written
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                try:
+                    if mapped is not None:
+                        mapped.close()
+                except BufferError: #a block is still being sent, freed with its last view
+                    pass
+            self._maps = {}
+            if self._fds is None:
+                return
+            for fd in self._fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self._fds = None
+
+
+if hasattr(os, 'pwrite'):
+    _pwrite = os.pwrite
+    _pread = os.pread
+else: #windows has no pwrite/pread, seek + write/read under a lock
+    _seek_lock = threading.Lock()
+
+    def _pwrite(fd, data, position):
+        with _seek_lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def _pread(fd, length, position):
+        with _seek_lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.read(fd, length)
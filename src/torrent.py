@@ -5,71 +5,189 @@ Gives tracker url
 """
 
 import hashlib
+from dataclasses import dataclass
 from pathlib import Path
-from .bencode import BencodeDecoder, BencodeEncoder
+from .bencode import BencodeDecoder
+
+HASH_SIZE = 20 #SHA1 digest
+
+
+def _text(value): #bencoded strings are bytes
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+
+
+class PieceHashes:
+    '''
+    SHA1 of every piece as 20 byte views into the one 'pieces' blob
+    len() and [index] are O(1), no list of slices is built
+    '''
+    __slots__ = ('_view', '_count')
+
+    def __init__(self, blob):
+        if len(blob) % HASH_SIZE:
+            raise ValueError("Invalid torrent: pieces length is not a multiple of 20")
+        self._view = memoryview(blob)
+        self._count = len(blob) // HASH_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("piece index out of range")
+        start = index * HASH_SIZE
+        return self._view[start:start + HASH_SIZE]
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    @property
+    def raw(self): #the whole blob, count * 20 bytes
+        return self._view
+
+
+@dataclass(frozen=True, slots=True)
+class FileEntry:
+    path: tuple #parts relative to download dir, torrent name first
+    length: int
+    offset: int #start of the file in the torrent byte stream
+
+
+@dataclass(frozen=True, slots=True)
+class TorrentMeta:
+    '''
+    read-only torrent metadata built once at parse time
+    '''
+    name: str
+    announce: str
+    trackers: tuple #announce + announce-list, no duplicates
+    piece_length: int
+    piece_hashes: PieceHashes
+    piece_count: int
+    last_piece_length: int
+    total_size: int
+    is_multi_file: bool
+    files: tuple #FileEntry for every file (single file torrents have one)
+
+    @classmethod
+    def from_dict(cls, data):
+        info = data['info']
+        name = _text(info.get('name', b'unknown'))
+        piece_length = info['piece length']
+        piece_hashes = PieceHashes(info['pieces'])
+
+        if 'length' in info:
+            is_multi_file = False
+            files = (FileEntry((name,), info['length'], 0),)
+        elif 'files' in info:
+            is_multi_file = True
+            entries = []
+            offset = 0
+            for file_info in info['files']:
+                path = tuple(_text(part) for part in file_info['path'])
+                entries.append(FileEntry((name,) + path, file_info['length'], offset))
+                offset += file_info['length']
+            files = tuple(entries)
+        else:
+            raise ValueError("Invalid torrent: no length or files")
+
+        announce = _text(data.get('announce', b''))
+        trackers = [announce] if announce else []
+        for tier in data.get('announce-list', []):
+            for url in tier:
+                url = _text(url)
+                if url not in trackers:
+                    trackers.append(url)
+
+        return cls.create(name, announce, tuple(trackers), piece_length, piece_hashes, files, is_multi_file)
+
+    @classmethod
+    def create(cls, name, announce, trackers, piece_length, piece_hashes, files, is_multi_file):
+        #derived fields (sizes, offsets) in one place
+        total_size = sum(f.length for f in files)
+        piece_count = len(piece_hashes)
+        return cls(
+            name=name,
+            announce=announce,
+            trackers=trackers,
+            piece_length=piece_length,
+            piece_hashes=piece_hashes,
+            piece_count=piece_count,
+            last_piece_length=total_size - piece_length * (piece_count - 1) if piece_count else 0,
+            total_size=total_size,
+            is_multi_file=is_multi_file,
+            files=files,
+        )
+
+    def piece_size(self, piece_index): #real length of piece
+        if piece_index == self.piece_count - 1:
+            return self.last_piece_length
+        return self.piece_length
 
 
 class TorrentFile:
-    def __init__(self, filepath):
+    def __init__(self, filepath, content=None, info_hash=None, meta=None):
         self.filepath = Path(filepath)
-        self.data = None
-        self.info_hash = None #SHA1 from bencoded info
-        self._parse()
+        self._data = None
+        self.info_hash = info_hash #SHA1 from bencoded info
+        self.meta = meta
+        if meta is None: #not restored from TorrentCache
+            self._parse(content)
+
+    @property
+    def data(self): #full decoded dict, cached torrents decode it on first use
+        if self._data is None:
+            self._parse()
+        return self._data
 
-    def _parse(self):
-        if not self.filepath.exists():
-            raise FileNotFoundError(f"Torrent file not found: {self.filepath}")
+    def _parse(self, content=None):
+        if content is None:
+            if not self.filepath.exists():
+                raise FileNotFoundError(f"Torrent file not found: {self.filepath}")
 
-        with open(self.filepath, 'rb') as f:
-            content = f.read()
+            with open(self.filepath, 'rb') as f:
+                content = f.read()
 
         decoder = BencodeDecoder(content)
-        self.data = decoder.decode()
+        self._data = decoder.decode()
 
-        self._calculate_info_hash() #calcucate (SHA1 of bencoded 'info' dict)
+        self._calculate_info_hash(decoder) #calcucate (SHA1 of raw bencoded 'info' dict)
+        self.meta = TorrentMeta.from_dict(self._data) #everything else computed once
 
-    def _calculate_info_hash(self):
-        if 'info' not in self.data:
+    def _calculate_info_hash(self, decoder):
+        if not isinstance(self._data, dict) or 'info' not in self._data or decoder.info_span is None:
             raise ValueError("Invalid torrent file: missing 'info' key")
-        info_bencoded = BencodeEncoder.encode(self.data['info'])
-        self.info_hash = hashlib.sha1(info_bencoded).digest()
+        start, end = decoder.info_span #exact input bytes, no re-encode
+        self.info_hash = hashlib.sha1(decoder.data[start:end]).digest()
 
     @property
     def announce(self):
-        url = self.data.get('announce', b'')
-        return url.decode('utf-8') if isinstance(url, bytes) else url
+        return self.meta.announce
 
     @property
     def name(self): #file name
-        name = self.data['info'].get('name', b'unknown')
-        return name.decode('utf-8') if isinstance(name, bytes) else name
+        return self.meta.name
 
     @property
     def piece_length(self): #length of each piece in bytes
-        return self.data['info']['piece length']
+        return self.meta.piece_length
 
     @property
     def pieces(self): #SHA1 hash of every piece
-        pieces_data = self.data['info']['pieces']
-        return [pieces_data[i:i+20] for i in range(0, len(pieces_data), 20)]
+        return self.meta.piece_hashes
 
     @property
     def total_size(self):
-        info = self.data['info']
-
-        if 'length' in info:
-            return info['length']
-
-        elif 'files' in info:
-            return sum(f['length'] for f in info['files'])
-        else:
-            raise ValueError("Invalid torrent: no length or files")
+        return self.meta.total_size
 
     @property
     def is_multi_file(self): #check
-        return 'files' in self.data['info']
+        return self.meta.is_multi_file
 
     def __repr__(self):
         return (f"TorrentFile(name='{self.name}', "
                 f"size={self.total_size}, "
-                f"pieces={len(self.pieces)})")
+                f"pieces={self.meta.piece_count})")
@@ -0,0 +1,203 @@
+"""
+on-disk cache of parsed torrents
+Keyed by SHA1 of the .torrent file content, so a changed file is a new key.
+Stores info_hash and TorrentMeta in a flat binary record (struct + raw pieces blob),
+loading it is a few unpack calls instead of a full bencode walk
+Torrents removed in the UI are remembered by content hash (their .torrent file
+is left alone), so they are not loaded again on restart
+"""
+
+import hashlib
+import os
+import struct
+from pathlib import Path
+from .torrent import TorrentFile, TorrentMeta, PieceHashes, FileEntry, HASH_SIZE
+
+MAGIC = b'MTC1' #bump on format change, old records are treated as misses
+_HEADER = struct.Struct(">4s20sQQB") #magic, info_hash, piece_length, total_size, is_multi_file
+_COUNT = struct.Struct(">I")
+_LENGTH = struct.Struct(">Q")
+
+
+class TorrentCache:
+    def __init__(self, cache_dir=".cache/torrents"):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.used = set() #content keys loaded by this process
+        self.removed_path = self.cache_dir / "removed"
+        self.removed = self._read_removed() #content keys of torrents the user removed
+
+    def load(self, filepath, content=None):
+        """
+        parsed torrent for filepath, from cache when the content was seen before
+        Args:
+            filepath: path to .torrent file
+            content: file bytes if caller already has them (saves a read)
+        Returns:
+            TorrentFile: full dict (torrent.data) is decoded lazily on first access
+        """
+        filepath = Path(filepath)
+        if content is None:
+            if not filepath.exists():
+                raise FileNotFoundError(f"Torrent file not found: {filepath}")
+            content = filepath.read_bytes()
+
+        key = self._key(content)
+        self.used.add(key)
+        if key in self.removed: #added again by the user
+            self.removed.discard(key)
+            self._write_removed()
+        cache_path = self._cache_path(content)
+        record = self._read(cache_path)
+        if record is not None:
+            self.hits += 1
+            info_hash, meta = record
+            return TorrentFile(filepath, info_hash=info_hash, meta=meta)
+
+        self.misses += 1
+        torrent = TorrentFile(filepath, content=content)
+        self._write(cache_path, torrent)
+        return torrent
+
+    def is_removed(self, content):
+        return self._key(content) in self.removed
+
+    def remove(self, filepath):
+        """
+        torrent removed by the user: drop its record and skip the file from now on
+        (the .torrent file itself stays where it is)
+        """
+        try:
+            content = Path(filepath).read_bytes()
+        except OSError: #file already gone, nothing would load it again
+            return
+        key = self._key(content)
+        self.used.discard(key)
+        self._cache_path(content).unlink(missing_ok=True)
+        self.removed.add(key)
+        self._write_removed()
+
+    def prune(self):
+        """
+        delete records no torrent loaded by this process uses (e.g. the .torrent
+        file was changed or deleted), call after loading everything at startup
+        Returns:
+            int: records deleted
+        """
+        pruned = 0
+        for cache_path in self.cache_dir.glob("*.bin"):
+            if cache_path.stem not in self.used:
+                cache_path.unlink(missing_ok=True)
+                pruned += 1
+        return pruned
+
+    @staticmethod
+    def _key(content):
+        return hashlib.sha1(content).hexdigest()
+
+    def _cache_path(self, content):
+        return self.cache_dir / (self._key(content) + ".bin")
+
+    def _read_removed(self):
+        try:
+            return set(self.removed_path.read_text().split())
+        except OSError:
+            return set()
+
+    def _write_removed(self):
+        tmp_path = self.removed_path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text("".join(key + "\n" for key in sorted(self.removed)))
+            os.replace(tmp_path, self.removed_path)
+        except OSError as e:
+            print(f"Torrent cache write failed: {e}")
+
+    def _read(self, cache_path):
+        try:
+            raw = cache_path.read_bytes()
+            return _unpack(raw)
+        except FileNotFoundError:
+            return None
+        except (ValueError, struct.error, UnicodeDecodeError): #corrupt or old record
+            return None
+
+    def _write(self, cache_path, torrent):
+        tmp_path = cache_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_pack(torrent.info_hash, torrent.meta))
+            os.replace(tmp_path, cache_path) #no half written records
+        except OSError as e:
+            print(f"Torrent cache write failed: {e}")
+
+
+def _pack_str(out, value):
+    value = value.encode('utf-8')
+    out += _COUNT.pack(len(value))
+    out += value
+
+
+def _pack(info_hash, meta):
+    out = bytearray(_HEADER.pack(MAGIC, info_hash, meta.piece_length, meta.total_size, meta.is_multi_file))
+    _pack_str(out, meta.name)
+    _pack_str(out, meta.announce)
+
+    out += _COUNT.pack(len(meta.trackers))
+    for url in meta.trackers:
+        _pack_str(out, url)
+
+    out += _COUNT.pack(len(meta.files))
+    for file_entry in meta.files:
+        out += _LENGTH.pack(file_entry.length)
+        out += _COUNT.pack(len(file_entry.path))
+        for part in file_entry.path:
+            _pack_str(out, part)
+
+    out += _COUNT.pack(meta.piece_count)
+    out += meta.piece_hashes.raw #one copy of the blob, no per piece loop
+    return bytes(out)
+
+
+def _unpack(raw):
+    view = memoryview(raw)
+    magic, info_hash, piece_length, total_size, is_multi_file = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Unknown cache format")
+    offset = _HEADER.size
+
+    def read_count():
+        nonlocal offset
+        value = _COUNT.unpack_from(view, offset)[0]
+        offset += _COUNT.size
+        return value
+
+    def read_str():
+        nonlocal offset
+        length = read_count()
+        value = str(view[offset:offset + length], 'utf-8')
+        offset += length
+        return value
+
+    name = read_str()
+    announce = read_str()
+    trackers = tuple(read_str() for _ in range(read_count()))
+
+    files = []
+    file_offset = 0
+    for _ in range(read_count()):
+        length = _LENGTH.unpack_from(view, offset)[0]
+        offset += _LENGTH.size
+        path = tuple(read_str() for _ in range(read_count()))
+        files.append(FileEntry(path, length, file_offset))
+        file_offset += length
+
+    piece_count = read_count()
+    blob = view[offset:offset + piece_count * HASH_SIZE]
+    if len(blob) != piece_count * HASH_SIZE or file_offset != total_size:
+        raise ValueError("Truncated cache record")
+
+    meta = TorrentMeta.create(name, announce, trackers, piece_length, PieceHashes(blob),
+                              tuple(files), bool(is_multi_file))
+    return info_hash, meta
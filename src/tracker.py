@@ -1,15 +1,23 @@
 """
-handles HTTP/HTTPS tracker requests
+handles HTTP/HTTPS and UDP tracker requests
 and peer list parsing
 """
 import os
+import queue
 import socket
 import struct
+import threading
 import requests
 from urllib.parse import urlencode, quote
+from .udp_tracker import UDPTrackerClient
 
 
 class TrackerClient:
+    DEFAULT_INTERVAL = 1800 #seconds between announces when the tracker doesn't say
+    DEFAULT_MIN_INTERVAL = 300 #soonest we announce again when the tracker doesn't say (UDP never does)
+    UDP_RETRIES = 1 #15 s + 30 s, then the next tracker (BEP 15 goes on for ~1 h)
+    PARALLEL = 3 #trackers asked at once, the first answer wins (a dead one doesn't hold up the rest)
+
     def __init__(self, torrent):
         self.torrent = torrent
         self.peer_id = self._generate_peer_id()
@@ -17,6 +25,9 @@ class TrackerClient:
         self.uploaded = 0
         self.downloaded = 0
         self.left = torrent.total_size
+        self.interval = self.DEFAULT_INTERVAL
+        self.min_interval = self.DEFAULT_MIN_INTERVAL
+        self.trackers = list(torrent.meta.trackers) or [torrent.announce] #announce + announce-list
 
     @staticmethod
     def _generate_peer_id():
@@ -24,14 +35,48 @@ class TrackerClient:
 
     def announce(self, event='started'):
         """
-        send announce request to tracker
+        send announce request to tracker, the torrent's trackers are asked PARALLEL
+        at a time in list order, the first one that answers goes first next time
         Args:
-            event: 'started', 'completed', or 'stopped'
+            event: 'started', 'completed', 'stopped', or None for a regular re-announce
         Returns:
             dict: tracker response with peers list
         """
-        tracker_url = self.torrent.announce
+        error = None
+        trackers = list(self.trackers)
+        for start in range(0, len(trackers), self.PARALLEL):
+            group = trackers[start:start + self.PARALLEL]
+            results = queue.Queue()
+            for tracker_url in group: #daemon threads: a slow loser never holds up shutdown
+                threading.Thread(target=self._announce_one, args=(tracker_url, event, results), daemon=True).start()
+            for _ in group:
+                tracker_url, tracker_response, e = results.get()
+                if e is not None:
+                    print(f"Tracker {tracker_url} failed: {e}")
+                    error = e
+                    continue
+                self.trackers.remove(tracker_url)
+                self.trackers.insert(0, tracker_url)
+                self._read_intervals(tracker_response)
+                return tracker_response
+        raise error or ValueError("Torrent has no trackers")
+
+    def _announce_one(self, tracker_url, event, results): #runs in its own thread, result goes to the queue
+        try:
+            if tracker_url.startswith('udp://'):
+                results.put((tracker_url, self._announce_udp(tracker_url, event), None))
+            else:
+                results.put((tracker_url, self._announce_http(tracker_url, event), None))
+        except Exception as e:
+            results.put((tracker_url, None, e))
+
+    def _announce_udp(self, tracker_url, event): #BEP 15, one datagram each way instead of an HTTP request
+        print(f"Connecting to tracker: {tracker_url}")
+        client = UDPTrackerClient(tracker_url, max_retries=self.UDP_RETRIES)
+        return client.announce(self.torrent.info_hash, self.peer_id, self.port,
+                               self.uploaded, self.downloaded, self.left, event)
 
+    def _announce_http(self, tracker_url, event):
         if not tracker_url.startswith(('http://', 'https://')): #check if tracker is supported
             raise ValueError(f"Unsupported tracker protocol: {tracker_url}")
 
@@ -43,8 +88,9 @@ class TrackerClient:
             'downloaded': self.downloaded,
             'left': self.left,
             'compact': 1, #compacting peer list
-            'event': event
         }
+        if event:
+            params['event'] = event
         query_string = self._build_query_string(params) #encode params for simplicit
         full_url = f"{tracker_url}?{query_string}"
 
@@ -70,6 +116,33 @@ class TrackerClient:
         except requests.RequestException as e:
             raise Exception(f"Failed connection to tracker: {e}")
 
+    def scrape(self):
+        """
+        swarm size without announcing, from the first UDP tracker that answers
+        Returns:
+            dict: complete (seeders), downloaded, incomplete (leechers)
+        """
+        error = None
+        for tracker_url in self.trackers:
+            if not tracker_url.startswith('udp://'):
+                continue
+            try:
+                client = UDPTrackerClient(tracker_url, max_retries=self.UDP_RETRIES)
+                return client.scrape([self.torrent.info_hash])[self.torrent.info_hash]
+            except Exception as e:
+                error = e
+        raise error or ValueError("No UDP tracker to scrape")
+
+    def _read_intervals(self, response): #when the tracker wants to hear from us again
+        interval = response.get('interval')
+        if isinstance(interval, int) and interval > 0:
+            self.interval = interval
+        min_interval = response.get('min interval')
+        if isinstance(min_interval, int) and min_interval > 0:
+            self.min_interval = min(min_interval, self.interval)
+        else: #a quarter of the interval, at least DEFAULT_MIN_INTERVAL
+            self.min_interval = min(self.interval, max(self.DEFAULT_MIN_INTERVAL, self.interval // 4))
+
     def _build_query_string(self, params): #query
         parts = []
         for key, value in params.items():
@@ -80,8 +153,8 @@ class TrackerClient:
             parts.append(f"{key}={encoded_value}")
         return '&'.join(parts)
 
-    def get_peers(self):
-        response = self.announce()
+    def get_peers(self, event='started'):
+        response = self.announce(event)
         peers_data = response.get(b'peers') or response.get('peers')
 
         if not peers_data:
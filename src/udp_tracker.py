@@ -0,0 +1,175 @@
+"""
+UDP tracker protocol (BEP 15)
+A connect exchange gets a connection id (reused for a minute), then announce or
+scrape go out as single datagrams. Lost packets are sent again after
+15 * 2^n seconds. Responses are checked for the transaction id and action
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+PROTOCOL_ID = 0x41727101980 #magic constant of the connect request
+
+CONNECT = 0
+ANNOUNCE = 1
+SCRAPE = 2
+ERROR = 3
+
+EVENTS = {None: 0, '': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+_CONNECT = struct.Struct(">QII") #protocol id / connection id, action, transaction id
+_HEADER = struct.Struct(">II") #action, transaction id
+_ANNOUNCE = struct.Struct(">QII20s20sQQQIIIiH")
+_ANNOUNCE_REPLY = struct.Struct(">IIIII") #action, transaction id, interval, leechers, seeders
+_SCRAPE_ENTRY = struct.Struct(">III") #seeders, completed, leechers
+
+_connections = {} #(host, port) -> (connection id, expires), shared by every client
+_connections_lock = threading.Lock()
+
+
+class UDPTrackerClient:
+    BASE_TIMEOUT = 15 #seconds, doubled for every retransmission
+    MAX_RETRIES = 8 #BEP 15: 15 * 2^8 s is the last try
+    CONNECTION_TTL = 60 #connection ids are good for a minute
+    MAX_SCRAPE = 74 #info hashes per scrape datagram
+
+    def __init__(self, url, max_retries=MAX_RETRIES, base_timeout=BASE_TIMEOUT):
+        parsed = urlparse(url)
+        if parsed.scheme != 'udp' or not parsed.hostname or not parsed.port:
+            raise ValueError(f"Invalid UDP tracker URL: {url}")
+        self.url = url
+        self.address = (parsed.hostname, parsed.port)
+        self.max_retries = max_retries
+        self.base_timeout = base_timeout
+
+    def announce(self, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0, event=None, num_want=-1):
+        """
+        Args:
+            event: 'started', 'completed', 'stopped', or None for a regular re-announce
+        Returns:
+            dict shaped like an HTTP tracker response:
+            interval, complete, incomplete, peers (compact 6 byte entries)
+        """
+        if event not in EVENTS:
+            raise ValueError(f"Unknown announce event: {event}")
+        key = struct.unpack(">I", peer_id[-4:])[0] #same for every announce of this client
+
+        def packet(connection_id, transaction_id):
+            return _ANNOUNCE.pack(connection_id, ANNOUNCE, transaction_id, info_hash, peer_id,
+                                  downloaded, left, uploaded, EVENTS[event], 0, key, num_want, port)
+
+        reply = self._exchange(packet, ANNOUNCE, _ANNOUNCE_REPLY.size)
+        _, _, interval, leechers, seeders = _ANNOUNCE_REPLY.unpack_from(reply)
+        peers = bytes(reply[_ANNOUNCE_REPLY.size:])
+        return {
+            'interval': interval,
+            'incomplete': leechers,
+            'complete': seeders,
+            'peers': peers[:len(peers) - len(peers) % 6], #compact IPv4 entries, same as HTTP
+        }
+
+    def scrape(self, info_hashes):
+        """
+        Returns:
+            dict: info_hash -> {'complete', 'downloaded', 'incomplete'}
+        """
+        info_hashes = list(info_hashes)
+        result = {}
+        for start in range(0, len(info_hashes), self.MAX_SCRAPE):
+            chunk = info_hashes[start:start + self.MAX_SCRAPE]
+
+            def packet(connection_id, transaction_id):
+                return _CONNECT.pack(connection_id, SCRAPE, transaction_id) + b''.join(chunk)
+
+            reply = self._exchange(packet, SCRAPE, _HEADER.size + _SCRAPE_ENTRY.size * len(chunk))
+            for index, info_hash in enumerate(chunk):
+                seeders, completed, leechers = _SCRAPE_ENTRY.unpack_from(reply, _HEADER.size + index * _SCRAPE_ENTRY.size)
+                result[info_hash] = {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+        return result
+
+    def _exchange(self, packet, action, min_size):
+        """
+        connect if needed, then send packet(connection_id, transaction_id) until a
+        matching reply comes back, the n-th try waits base_timeout * 2^n
+        Returns:
+            bytes: the reply
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            address = socket.getaddrinfo(*self.address, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+            attempt = 0
+            while attempt <= self.max_retries:
+                connection_id = self._cached_connection()
+                if connection_id is None:
+                    transaction_id = _transaction_id()
+                    request = _CONNECT.pack(PROTOCOL_ID, CONNECT, transaction_id)
+                    reply = self._send_receive(sock, address, request, CONNECT, transaction_id, 16, attempt)
+                    if reply is None:
+                        attempt += 1
+                        continue
+                    connection_id = struct.unpack_from(">Q", reply, 8)[0]
+                    self._cache_connection(connection_id)
+
+                transaction_id = _transaction_id()
+                reply = self._send_receive(sock, address, packet(connection_id, transaction_id),
+                                           action, transaction_id, min_size, attempt)
+                if reply is not None:
+                    return reply
+                self._forget_connection() #may have expired on the tracker's side
+                attempt += 1
+        except OSError as e:
+            raise Exception(f"Failed connection to tracker: {e}")
+        finally:
+            sock.close()
+        raise Exception(f"Failed connection to tracker: {self.url} timed out")
+
+    def _send_receive(self, sock, address, request, action, transaction_id, min_size, attempt):
+        """
+        one try: send and wait for the reply to this transaction
+        Returns:
+            bytes or None on timeout (late replies of earlier tries are skipped)
+        """
+        sock.sendto(request, address)
+        deadline = time.monotonic() + self.base_timeout * 2 ** attempt
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                reply, sender = sock.recvfrom(65536)
+            except socket.timeout:
+                return None
+            if sender[:2] != address[:2] or len(reply) < _HEADER.size:
+                continue
+            reply_action, reply_transaction = _HEADER.unpack_from(reply)
+            if reply_transaction != transaction_id:
+                continue
+            if reply_action == ERROR:
+                message = reply[_HEADER.size:].decode('utf-8', errors='replace')
+                raise Exception(f"Tracker error: {message}")
+            if reply_action == action and len(reply) >= min_size:
+                return reply
+
+    def _cached_connection(self):
+        with _connections_lock:
+            entry = _connections.get(self.address)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def _cache_connection(self, connection_id):
+        with _connections_lock:
+            _connections[self.address] = (connection_id, time.monotonic() + self.CONNECTION_TTL)
+
+    def _forget_connection(self):
+        with _connections_lock:
+            _connections.pop(self.address, None)
+
+
+def _transaction_id():
+    return struct.unpack(">I", os.urandom(4))[0]
@@ -0,0 +1,103 @@
+"""
+upload side: answers peers' REQUESTs for pieces we have
+Blocks inside one file are mmap slices sent without copying (the page cache
+keeps hot pieces), blocks spanning files come from a small LRU of whole pieces
+"""
+
+import asyncio
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+
+
+class PieceCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pieces = OrderedDict() #piece index -> bytes, oldest first
+        self._lock = threading.Lock()
+
+    def get(self, piece_index):
+        with self._lock:
+            data = self.pieces.get(piece_index)
+            if data is not None:
+                self.pieces.move_to_end(piece_index)
+            return data
+
+    def put(self, piece_index, data):
+        with self._lock:
+            if piece_index in self.pieces:
+                return
+            self.pieces[piece_index] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.pieces) > 1:
+                _, evicted = self.pieces.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Uploader:
+    MAX_BLOCK = 1 << 17 #128 KB, bigger requests are dropped like other clients do
+
+    def __init__(self, piece_manager, cache=None):
+        self.piece_manager = piece_manager
+        self.storage = piece_manager.storage
+        self.cache = cache or PieceCache()
+
+    def handle_request(self, peer, payload):
+        """
+        REQUEST from a peer, sends the block if it is valid
+        Returns:
+            bool: True if the block was sent
+        """
+        index, begin, length = struct.unpack_from(">III", payload)
+        if not self._valid(peer, index, begin, length):
+            if peer.supports_fast: #fast extension peers are told instead of timing out
+                peer.send_reject(index, begin, length)
+            return False
+
+        peer.send_block(index, begin, self.block(index, begin, length))
+        self.piece_manager.stats.block_uploaded(length)
+        return True
+
+    async def handle_request_async(self, peer, payload):
+        """
+        handle_request for async peers, the disk read (or mmap page faults)
+        happens in a worker thread so a cold block never stalls the event loop,
+        the block itself still goes out as the mmap slice, not a copy
+        """
+        index, begin, length = struct.unpack_from(">III", payload) #payload is only valid until we await
+        if not self._valid(peer, index, begin, length):
+            if peer.supports_fast:
+                peer.send_reject(index, begin, length)
+            return False
+
+        block = await asyncio.to_thread(self._paged_in_block, index, begin, length)
+        if peer.am_choking: #choked while reading, the request is void
+            return False
+        peer.send_block(index, begin, block)
+        self.piece_manager.stats.block_uploaded(length)
+        return True
+
+    def _paged_in_block(self, piece_index, begin, length): #worker thread: block, with its pages already in memory
+        block = self.block(piece_index, begin, length)
+        block[::mmap.PAGESIZE].tobytes() #one byte per page faults the mapping in, the send then finds it cached
+        return block
+
+    def _valid(self, peer, index, begin, length):
+        meta = self.piece_manager.meta
+        if peer.am_choking: #choked peers' requests are dropped
+            return False
+        if not 0 < length <= self.MAX_BLOCK or not 0 <= index < meta.piece_count:
+            return False
+        return begin + length <= meta.piece_size(index) and self.piece_manager.have_pieces[index]
+
+    def block(self, piece_index, begin, length):
+        view = self.storage.map_block(piece_index, begin, length)
+        if view is not None:
+            return view
+        data = self.cache.get(piece_index)
+        if data is None:
+            data = bytes(self.storage.read_piece(piece_index))
+            self.cache.put(piece_index, data)
+        return memoryview(data)[begin:begin + length]
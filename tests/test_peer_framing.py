@@ -0,0 +1,107 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+from src.async_peer import AsyncPeerConnection
+from src.framing import MessageBuffer
+from src.peer import PeerConnection, MessageType, MAX_MESSAGE
+
+
+def connected_pair(piece_count=100):
+    """PeerConnection on one end of a socketpair, raw socket on the other"""
+    ours, theirs = socket.socketpair()
+    peer = PeerConnection("127.0.0.1", 0, b"\x00" * 20, b"\x00" * 20, piece_count)
+    peer.socket = ours
+    peer.inbox = MessageBuffer()
+    peer.connected = True
+    return peer, theirs
+
+
+class BoundedLengthTest(unittest.TestCase):
+    def test_huge_length_prefix_is_rejected_before_buffering(self):
+        peer, remote = connected_pair()
+        remote.sendall(struct.pack(">IB", 200_000_000, MessageType.BITFIELD))
+        with self.assertRaises(Exception):
+            peer.receive_message(timeout=1)
+        self.assertFalse(peer.connected)
+        self.assertEqual(len(peer.inbox.buffer), MessageBuffer.DEFAULT_SIZE) #never grown
+        remote.close()
+
+    def test_piece_longer_than_a_block_is_rejected(self):
+        peer, remote = connected_pair()
+        remote.sendall(struct.pack(">IB", MAX_MESSAGE + 1, MessageType.PIECE))
+        with self.assertRaises(Exception):
+            peer.receive_message(timeout=1)
+        self.assertFalse(peer.connected)
+        remote.close()
+
+    def test_bitfield_is_limited_by_piece_count(self):
+        peer, remote = connected_pair(piece_count=100) #13 bytes of bitfield
+        remote.sendall(struct.pack(">IB", 1 + 13, MessageType.BITFIELD) + b"\xff" * 12 + b"\xf0")
+        message = peer.receive_message(timeout=1)
+        self.assertEqual(message[0], MessageType.BITFIELD)
+        self.assertEqual(peer.peer_pieces.count, 100)
+
+        remote.sendall(struct.pack(">IB", 1 + 14, MessageType.BITFIELD))
+        with self.assertRaises(Exception):
+            peer.receive_message(timeout=1)
+        remote.close()
+
+    def test_full_block_is_accepted(self):
+        peer, remote = connected_pair()
+        block = bytes(range(256)) * 64 #16 KiB
+        remote.sendall(struct.pack(">IBII", 9 + len(block), MessageType.PIECE, 3, 0) + block)
+        message_id, payload = peer.receive_message(timeout=1)
+        self.assertEqual(message_id, MessageType.PIECE)
+        self.assertEqual(bytes(payload[8:]), block)
+        remote.close()
+
+
+class AsyncBoundedLengthTest(unittest.IsolatedAsyncioTestCase):
+    async def test_huge_length_prefix_is_rejected(self):
+        async def send_huge(reader, writer):
+            writer.write(struct.pack(">IB", 200_000_000, MessageType.EXTENDED) + b"\x00" * 1024)
+            await writer.drain()
+            await reader.read() #until we hang up
+
+        server = await asyncio.start_server(send_huge, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        peer = AsyncPeerConnection("127.0.0.1", port, b"\x00" * 20, b"\x00" * 20, 100)
+        self.assertTrue(await peer.connect())
+        with self.assertRaises(Exception):
+            await peer.receive_message(timeout=1)
+        self.assertFalse(peer.connected)
+        server.close()
+        await server.wait_closed()
+
+    async def test_block_split_across_reads(self):
+        block = bytes(range(256)) * 64
+        message = struct.pack(">IBII", 9 + len(block), MessageType.PIECE, 3, 0) + block
+        proceed = asyncio.Event()
+
+        async def send_in_halves(reader, writer):
+            writer.write(message[:5000])
+            await writer.drain()
+            await proceed.wait()
+            writer.write(message[5000:])
+            await writer.drain()
+            await reader.read()
+
+        server = await asyncio.start_server(send_in_halves, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        peer = AsyncPeerConnection("127.0.0.1", port, b"\x00" * 20, b"\x00" * 20, 100)
+        self.assertTrue(await peer.connect())
+        self.assertIsNone(await peer.receive_message(timeout=0.2)) #half a message, kept
+        proceed.set()
+        message_id, payload = await peer.receive_message(timeout=1)
+        self.assertEqual(message_id, MessageType.PIECE)
+        self.assertEqual(bytes(payload[8:]), block)
+        self.assertEqual(peer.download_rate.total, len(block))
+        peer.close()
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == "__main__":
+    unittest.main()
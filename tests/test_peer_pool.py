@@ -0,0 +1,66 @@
+import unittest
+
+from src.peer_pool import PeerPool, Candidate
+from src.stats import RateMeter
+
+
+async def never_connects(ip, port):
+    return None
+
+
+async def run_nothing(peer):
+    return None
+
+
+class StarvingTest(unittest.TestCase):
+    def test_starving_only_without_candidates_to_try(self):
+        pool = PeerPool(never_connects, run_nothing, target=200)
+        self.assertTrue(pool.starving())
+        pool.add([("10.0.0.1", 6881)])
+        self.assertFalse(pool.starving()) #far fewer than the free slots, but still something to try
+
+        pool.candidates[("10.0.0.1", 6881)].next_try = float("inf") #backing off
+        self.assertTrue(pool.starving())
+
+    def test_full_pool_is_not_starving(self):
+        pool = PeerPool(never_connects, run_nothing, target=0)
+        self.assertFalse(pool.starving())
+
+
+class FakePeer:
+    def __init__(self, was_unchoked=False):
+        self.ip, self.port = "10.0.0.1", 6881
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        self.was_unchoked = was_unchoked
+
+    def close(self):
+        pass
+
+
+class BackoffTest(unittest.IsolatedAsyncioTestCase):
+    async def finished(self, peer):
+        pool = PeerPool(never_connects, run_nothing)
+        candidate = Candidate((peer.ip, peer.port))
+        candidate.failures = 3
+        pool.candidates[candidate.address] = candidate
+        await pool._run(candidate, peer)
+        return candidate
+
+    async def test_silent_choking_peer_keeps_backing_off(self):
+        candidate = await self.finished(FakePeer())
+        self.assertEqual(candidate.failures, 4)
+
+    async def test_peer_that_unchoked_us_comes_back_soon(self):
+        candidate = await self.finished(FakePeer(was_unchoked=True))
+        self.assertEqual(candidate.failures, 0)
+
+    async def test_peer_that_sent_data_comes_back_soon(self):
+        peer = FakePeer()
+        peer.download_rate.add(16384)
+        candidate = await self.finished(peer)
+        self.assertEqual(candidate.failures, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+
+from src.bencode import BencodeEncoder
+from src.bitfield import Bitfield
+from src.piece_manager import PieceManager
+from src.torrent import TorrentFile
+
+PIECE_LENGTH = 32768 #two blocks per piece
+
+
+class RecordingVerifier:
+    """keeps what was handed over for hashing, never calls back"""
+    def __init__(self):
+        self.submitted = []
+        self.callbacks = []
+        self.full = False
+        self.workers = 2
+
+    def busy(self):
+        return self.full
+
+    def submit(self, data, expected_hash, callback):
+        self.submitted.append((data, bytes(data)))
+        self.callbacks.append(callback)
+
+
+class FakePeer:
+    def __init__(self, pieces=None):
+        self.cancelled = []
+        self.peer_pieces = pieces or Bitfield.full(2)
+
+    def has_piece(self, piece_index):
+        return self.peer_pieces[piece_index]
+
+    def send_cancel(self, piece_index, begin, length):
+        self.cancelled.append((piece_index, begin, length))
+
+
+class TempTorrentTest(unittest.TestCase):
+    """two piece torrent in a temporary directory, PieceManager with a RecordingVerifier"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.content = os.urandom(PIECE_LENGTH * 2)
+        pieces = b''.join(hashlib.sha1(self.content[i:i + PIECE_LENGTH]).digest()
+                          for i in range(0, len(self.content), PIECE_LENGTH))
+        info = {'name': 'data.bin', 'length': len(self.content), 'piece length': PIECE_LENGTH, 'pieces': pieces}
+        self.torrent_path = os.path.join(self.tmp.name, 'data.torrent')
+        with open(self.torrent_path, 'wb') as f:
+            f.write(BencodeEncoder.encode({'announce': 'http://127.0.0.1:1/announce', 'info': info}))
+        self.verifier = RecordingVerifier()
+        self.manager = self.open_manager()
+
+    def open_manager(self): #a new run over the same download and resume directories
+        return PieceManager(TorrentFile(self.torrent_path), os.path.join(self.tmp.name, 'downloads'),
+                            verifier=self.verifier, resume_dir=os.path.join(self.tmp.name, 'resume'))
+
+    def tearDown(self):
+        self.manager.storage.close() #save_to_disk would wait for the verifier
+        self.tmp.cleanup()
+
+
+class AvailabilityTest(TempTorrentTest):
+    def test_have_is_counted_once(self):
+        peer = FakePeer(Bitfield(2))
+        self.manager.add_peer(peer)
+        self.manager.peer_have(peer, 1)
+        self.manager.peer_have(peer, 1)
+        self.assertEqual(self.manager.picker.availability, [0, 1])
+        self.manager.remove_peer(peer)
+        self.assertEqual(self.manager.picker.availability, [0, 0])
+
+    def test_late_bitfield_replaces_the_earlier_count(self):
+        pieces = Bitfield(2)
+        pieces.set(1)
+        peer = FakePeer(pieces)
+        self.manager.add_peer(peer)
+        self.assertEqual(self.manager.picker.availability, [0, 1])
+
+        peer.peer_pieces = Bitfield.full(2) #HAVE_ALL after a bitfield
+        self.manager.add_peer(peer)
+        self.assertEqual(self.manager.picker.availability, [0, 0])
+        self.assertEqual(self.manager.picker.seeds, 1)
+
+        self.manager.remove_peer(peer)
+        self.assertEqual(self.manager.picker.seeds, 0)
+
+    def test_seed_is_counted_without_touching_pieces(self):
+        seed = FakePeer()
+        self.manager.add_peer(seed)
+        self.manager.peer_have(seed, 0) #already counted
+        self.assertEqual(self.manager.picker.availability, [0, 0])
+        self.assertEqual(self.manager.picker.seeds, 1)
+        self.assertIn(self.manager.picker.pick(seed.has_piece, seed.peer_pieces), (0, 1))
+
+        self.manager.remove_peer(seed)
+        self.assertIsNone(self.manager.picker.pick(seed.has_piece, seed.peer_pieces)) #nobody has anything
+
+
+class ReceiveBlockTest(TempTorrentTest):
+    def setUp(self):
+        super().setUp()
+        self.manager.init_piece_download(0)
+
+    def block(self, begin):
+        return self.content[begin:begin + PieceManager.BLOCK_SIZE]
+
+    def test_unrequested_block_is_not_written(self):
+        peer = FakePeer()
+        self.assertIsNone(self.manager.receive_block(peer, 0, 0, b'\xff' * PieceManager.BLOCK_SIZE))
+        self.assertEqual(bytes(self.manager.pending_blocks[0].data), bytes(PIECE_LENGTH))
+        self.assertEqual(self.manager.stats.wasted, PieceManager.BLOCK_SIZE)
+
+    def test_late_duplicate_cannot_touch_a_piece_being_hashed(self):
+        fast, slow = FakePeer(), FakePeer()
+        second = PieceManager.BLOCK_SIZE
+        for peer, begin in ((fast, 0), (fast, second), (slow, second)): #endgame: both asked for the tail
+            self.manager.request_sent(peer, 0, begin)
+
+        self.assertIsNotNone(self.manager.receive_block(fast, 0, 0, self.block(0)))
+        self.assertIsNotNone(self.manager.receive_block(fast, 0, second, self.block(second)))
+        self.assertEqual(len(self.verifier.submitted), 1)
+        self.assertFalse(self.manager.is_pending(0))
+        self.assertEqual(slow.cancelled, [(0, second, PieceManager.BLOCK_SIZE)])
+
+        self.assertIsNone(self.manager.receive_block(slow, 0, second, b'\xff' * PieceManager.BLOCK_SIZE))
+        data, snapshot = self.verifier.submitted[0]
+        self.assertEqual(bytes(data), snapshot)
+        self.assertEqual(snapshot, self.content[:PIECE_LENGTH])
+        self.assertEqual(self.manager.stats.wasted, PieceManager.BLOCK_SIZE)
+
+    def test_no_new_pieces_while_the_verifier_is_busy(self):
+        peer = FakePeer()
+        self.manager.add_peer(peer)
+        self.verifier.full = True
+        blocks = self.manager.next_blocks(peer, 10)
+        self.assertEqual({piece_index for piece_index, _, _ in blocks}, {0}) #only the piece already started
+        self.assertEqual(self.manager.next_blocks(peer, 10), [])
+
+        self.verifier.full = False
+        self.assertEqual({piece_index for piece_index, _, _ in self.manager.next_blocks(peer, 10)}, {1})
+
+    def test_rejected_block_goes_back_on_the_queue(self):
+        first, second = FakePeer(), FakePeer()
+        size = PieceManager.BLOCK_SIZE
+        self.assertEqual(self.manager.next_blocks(first, 1), [(0, 0, size)])
+        self.assertEqual(self.manager.next_blocks(second, 1), [(0, size, size)])
+        self.manager.request_rejected(first, 0, 0)
+        self.assertEqual(self.manager.next_blocks(second, 1), [(0, 0, size)])
+
+    def test_timed_out_block_goes_back_on_the_queue(self):
+        first, second = FakePeer(), FakePeer()
+        size = PieceManager.BLOCK_SIZE
+        self.manager.BLOCK_TIMEOUT = 0.05
+        self.verifier.full = True #no new pieces, only piece 0 to share
+        self.assertEqual(self.manager.next_blocks(first, 2), [(0, 0, size), (0, size, size)])
+        self.assertEqual(self.manager.next_blocks(second, 2), [])
+
+        time.sleep(0.06)
+        self.assertEqual(self.manager.next_blocks(first, 2), []) #its own late requests aren't handed back
+        self.assertEqual(sorted(self.manager.next_blocks(second, 2)), [(0, 0, size), (0, size, size)])
+        self.assertEqual(self.manager.next_blocks(second, 2), [])
+
+    def test_failed_write_puts_the_piece_back(self):
+        peer = FakePeer()
+        self.manager.add_peer(peer)
+        for begin in (0, PieceManager.BLOCK_SIZE):
+            self.manager.add_block(0, begin, self.block(begin))
+
+        def disk_full(piece_index, data, begin=0):
+            raise OSError(28, "No space left on device")
+        self.manager.storage.write_piece = disk_full
+        self.verifier.callbacks[0](True)
+
+        self.assertFalse(self.manager.have_pieces[0])
+        self.assertTrue(self.manager.picker.is_wanted(0))
+        self.assertEqual(self.manager.verifying, 0)
+        self.assertIn("No space left", self.manager.error)
+
+
+class RestoreStateTest(TempTorrentTest):
+    """piece 0 on disk is good, piece 1 is garbage, so a recheck finds only piece 0"""
+    def setUp(self):
+        super().setUp()
+        self.path = self.manager.storage.file_path(0)
+        self.write_file(self.content[:PIECE_LENGTH] + bytes(PIECE_LENGTH))
+
+    def write_file(self, data):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def save_resume(self, have_pieces):
+        self.manager.resume.save(have_pieces, self.manager.storage.file_stats())
+
+    def restart(self):
+        self.manager.storage.close()
+        self.manager = self.open_manager()
+        return list(self.manager.have_pieces)
+
+    def test_saved_bitfield_is_trusted(self):
+        self.save_resume(Bitfield.full(2))
+        self.assertEqual(self.restart(), [0, 1]) #piece 1 not rehashed
+        self.assertEqual(self.manager.downloaded_bytes, PIECE_LENGTH * 2)
+
+    def test_touched_file_is_rechecked(self):
+        self.save_resume(Bitfield.full(2))
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.restart(), [0])
+
+    def test_wrong_size_file_is_never_trusted(self):
+        self.write_file(self.content[:PIECE_LENGTH]) #truncated
+        self.save_resume(Bitfield.full(2)) #even with matching stats
+        self.assertEqual(self.restart(), [])
+
+    def test_without_resume_file_everything_is_rechecked(self):
+        self.manager.resume.delete()
+        self.assertEqual(self.restart(), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
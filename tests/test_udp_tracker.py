@@ -0,0 +1,155 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from src import udp_tracker
+from src.bencode import BencodeEncoder
+from src.torrent import TorrentFile
+from src.tracker import TrackerClient
+from src.udp_tracker import UDPTrackerClient, PROTOCOL_ID
+
+INFO_HASH = b"A" * 20
+PEER_ID = b"-MT0001-" + b"1" * 12
+
+
+class FakeUDPTracker:
+    """BEP 15 tracker on localhost, drops the first `drop` datagrams it gets"""
+    def __init__(self, drop=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.url = f"udp://127.0.0.1:{self.sock.getsockname()[1]}/announce"
+        self.drop = drop
+        self.connection_ids = set()
+        self.actions = [] #action of every datagram answered
+        self.last_announce = None
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except OSError: #closed
+                return
+            if self.drop > 0:
+                self.drop -= 1
+                continue
+            connection_id, action, transaction_id = struct.unpack_from(">QII", data)
+            self.actions.append(action)
+            #late reply of some other transaction first, the client must skip it
+            self.sock.sendto(struct.pack(">II", action, transaction_id ^ 1), address)
+            if action == udp_tracker.CONNECT and connection_id == PROTOCOL_ID:
+                connection_id = int.from_bytes(os.urandom(8), "big")
+                self.connection_ids.add(connection_id)
+                self.sock.sendto(struct.pack(">IIQ", action, transaction_id, connection_id), address)
+            elif connection_id not in self.connection_ids:
+                continue #unknown connection id, real trackers don't answer
+            elif action == udp_tracker.ANNOUNCE:
+                self.last_announce = struct.unpack_from(">20s20sQQQIIIiH", data, 16)
+                if self.last_announce[0] == b"E" * 20:
+                    self.sock.sendto(struct.pack(">II", udp_tracker.ERROR, transaction_id) + b"unregistered torrent", address)
+                    continue
+                peers = socket.inet_aton("10.0.0.1") + struct.pack(">H", 6881)
+                self.sock.sendto(struct.pack(">IIIII", action, transaction_id, 900, 3, 7) + peers, address)
+            elif action == udp_tracker.SCRAPE:
+                count = (len(data) - 16) // 20
+                entries = b"".join(struct.pack(">III", 5 + i, 9, 2) for i in range(count))
+                self.sock.sendto(struct.pack(">II", action, transaction_id) + entries, address)
+
+
+class UDPTrackerTest(unittest.TestCase):
+    def setUp(self):
+        udp_tracker._connections.clear()
+        self.trackers = []
+
+    def tearDown(self):
+        for tracker in self.trackers:
+            tracker.close()
+
+    def tracker(self, drop=0):
+        tracker = FakeUDPTracker(drop)
+        self.trackers.append(tracker)
+        return tracker
+
+    def test_connect_then_announce(self):
+        tracker = self.tracker()
+        client = UDPTrackerClient(tracker.url, base_timeout=0.2)
+        response = client.announce(INFO_HASH, PEER_ID, 6881, left=100, event="started")
+        self.assertEqual(response["interval"], 900)
+        self.assertEqual((response["complete"], response["incomplete"]), (7, 3))
+        self.assertEqual(response["peers"], socket.inet_aton("10.0.0.1") + struct.pack(">H", 6881))
+        self.assertEqual(tracker.last_announce[5], udp_tracker.EVENTS["started"])
+
+        client.announce(INFO_HASH, PEER_ID, 6881, event="completed")
+        self.assertEqual(tracker.last_announce[5], udp_tracker.EVENTS["completed"])
+        self.assertEqual(tracker.actions.count(udp_tracker.CONNECT), 1) #connection id reused
+
+    def test_retransmits_after_dropped_packet(self):
+        tracker = self.tracker(drop=1)
+        client = UDPTrackerClient(tracker.url, base_timeout=0.2)
+        started = time.monotonic()
+        client.announce(INFO_HASH, PEER_ID, 6881)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2) #waited out the first timeout
+        self.assertEqual(tracker.actions, [udp_tracker.CONNECT, udp_tracker.ANNOUNCE])
+
+    def test_gives_up_after_max_retries(self):
+        tracker = self.tracker(drop=100)
+        client = UDPTrackerClient(tracker.url, max_retries=1, base_timeout=0.05)
+        with self.assertRaises(Exception):
+            client.announce(INFO_HASH, PEER_ID, 6881)
+
+    def test_scrape(self):
+        tracker = self.tracker()
+        client = UDPTrackerClient(tracker.url, base_timeout=0.2)
+        result = client.scrape([INFO_HASH, b"B" * 20])
+        self.assertEqual(result[INFO_HASH], {"complete": 5, "downloaded": 9, "incomplete": 2})
+        self.assertEqual(result[b"B" * 20]["complete"], 6)
+
+    def test_error_reply(self):
+        tracker = self.tracker()
+        client = UDPTrackerClient(tracker.url, base_timeout=0.2)
+        with self.assertRaisesRegex(Exception, "unregistered torrent"):
+            client.announce(b"E" * 20, PEER_ID, 6881)
+
+    def test_expired_connection_id_reconnects(self):
+        tracker = self.tracker()
+        client = UDPTrackerClient(tracker.url, base_timeout=0.1)
+        client.announce(INFO_HASH, PEER_ID, 6881)
+        tracker.connection_ids.clear() #tracker forgot us, announce goes unanswered
+        client.announce(INFO_HASH, PEER_ID, 6881)
+        self.assertEqual(tracker.actions.count(udp_tracker.CONNECT), 2)
+
+
+class TrackerClientTest(unittest.TestCase):
+    def setUp(self):
+        udp_tracker._connections.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dead, self.live = FakeUDPTracker(drop=100), FakeUDPTracker()
+        info = {'name': 'data.bin', 'length': 16384, 'piece length': 16384, 'pieces': b'\x00' * 20}
+        path = os.path.join(self.tmp.name, 'data.torrent')
+        with open(path, 'wb') as f:
+            f.write(BencodeEncoder.encode({'announce': self.dead.url, 'info': info}))
+        self.client = TrackerClient(TorrentFile(path))
+
+    def tearDown(self):
+        self.dead.close()
+        self.live.close()
+        self.tmp.cleanup()
+
+    def test_dead_tracker_does_not_hold_up_the_announce(self):
+        self.client.trackers = [self.dead.url, self.live.url]
+        started = time.monotonic()
+        response = self.client.announce()
+        self.assertLess(time.monotonic() - started, 5) #the dead one alone would take 45 s
+        self.assertEqual(response["peers"], socket.inet_aton("10.0.0.1") + struct.pack(">H", 6881))
+        self.assertEqual(self.client.trackers, [self.live.url, self.dead.url]) #answered first, goes first
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,17 +4,59 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
 import sys
+from contextlib import asynccontextmanager
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-import threading
+from pydantic import BaseModel
 
 sys.path.append(str(Path(__file__).parent))
-from src.torrent import TorrentFile
+from src.torrent_cache import TorrentCache
 from src.tracker import TrackerClient
-from src.peer import PeerConnection
+from src.async_peer import AsyncPeerConnection
 from src.downloader import Downloader
+from src.piece_manager import PieceManager
+from src.choker import Choker
+from src.peer_pool import PeerPool
+from src.shaper import TorrentLimits, global_limits
 
-app = FastAPI(title="MiniTorrentAPI")
+active_torrents = {}
+torrent_cache = TorrentCache() #parsed .torrent files, survives restarts
+
+def register_torrent(torrent):
+    info_hash = torrent.info_hash.hex()
+    active_torrents[info_hash] = {
+        "name": torrent.name,
+        "total_size": torrent.total_size,
+        "piece_count": torrent.meta.piece_count,
+        "tracker": torrent.announce,
+        "status": "paused",
+        "progress": 0,
+        "download_speed": 0,
+        "upload_speed": 0,
+        "peers_connected": 0,
+        "downloaded_pieces": 0,
+        "torrent": torrent,
+        "limits": TorrentLimits(), #bytes/s, 0 = unlimited, changed through /limits
+    }
+    return info_hash
+
+def load_saved_torrents(torrents_dir=Path("torrents")): #re-register torrents/ after restart
+    for file_path in sorted(torrents_dir.glob("*.torrent")):
+        try:
+            content = file_path.read_bytes()
+            if torrent_cache.is_removed(content): #removed in the UI earlier
+                continue
+            register_torrent(torrent_cache.load(file_path, content))
+        except Exception as e:
+            print(f"Skipping {file_path.name}: {e}")
+    torrent_cache.prune() #records of changed or deleted .torrent files
+    print(f"Loaded {len(active_torrents)} torrents (cache hits: {torrent_cache.hits}, misses: {torrent_cache.misses})")
+
+@asynccontextmanager
+async def lifespan(app):
+    load_saved_torrents()
+    yield
+
+app = FastAPI(title="MiniTorrentAPI", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware, #allows browser to safe request from different domains
@@ -24,8 +66,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-active_torrents = {}
-
 class ConnectionManager:
     def __init__(self):
         self.active_connections = []
@@ -45,6 +85,12 @@ class ConnectionManager:
                 pass
 
 manager = ConnectionManager()
+RESUME_SAVE_INTERVAL = 10 #seconds between resume file writes while downloading
+MAX_PEERS = 200 #live connections kept per torrent, all on the event loop
+MAX_CONNECTING = 50 #connection attempts in flight at once, per torrent
+#connection setup deadlines per stage, the unchoke wait is the worker's (Downloader.CHOKE_TIMEOUT)
+CONNECT_TIMEOUT = 3 #TCP connect
+HANDSHAKE_TIMEOUT = 5 #peer's handshake after ours
 
 @app.get("/")
 async def read_root():
@@ -63,9 +109,46 @@ async def get_torrents():
             "upload_speed": data.get("upload_speed", 0),
             "peers_connected": data.get("peers_connected", 0),
             "status": data.get("status", "paused"),
+            "limits": data["limits"].to_dict(),
         })
     return {"torrents": torrents}
 
+class RateLimits(BaseModel): #bytes/s, 0 = unlimited, missing = unchanged
+    download: int | None = None
+    upload: int | None = None
+    peer_download: int | None = None #per peer of the torrent, ignored for the global limits
+    peer_upload: int | None = None
+
+def check_limits(limits):
+    values = (limits.download, limits.upload, limits.peer_download, limits.peer_upload)
+    if any(value is not None and value < 0 for value in values):
+        raise HTTPException(status_code=400, detail="Rate limits must be >= 0 (0 = unlimited)")
+
+@app.get("/api/limits")
+async def get_limits():
+    return global_limits.to_dict()
+
+@app.post("/api/limits")
+async def set_limits(limits: RateLimits):
+    check_limits(limits)
+    global_limits.set(limits.download, limits.upload)
+    return {"success": True, "limits": global_limits.to_dict()}
+
+@app.get("/api/torrents/{info_hash}/limits")
+async def get_torrent_limits(info_hash: str):
+    if info_hash not in active_torrents:
+        raise HTTPException(status_code=404, detail="Torrent not found")
+    return active_torrents[info_hash]["limits"].to_dict()
+
+@app.post("/api/torrents/{info_hash}/limits")
+async def set_torrent_limits(info_hash: str, limits: RateLimits):
+    if info_hash not in active_torrents:
+        raise HTTPException(status_code=404, detail="Torrent not found")
+    check_limits(limits)
+    torrent_limits = active_torrents[info_hash]["limits"]
+    torrent_limits.set(limits.download, limits.upload, limits.peer_download, limits.peer_upload)
+    return {"success": True, "limits": torrent_limits.to_dict()}
+
 @app.post("/api/torrents/add")
 async def add_torrent(file: UploadFile = File(...)):
     try:
@@ -77,22 +160,8 @@ async def add_torrent(file: UploadFile = File(...)):
             content = await file.read()
             f.write(content)
 
-        torrent = TorrentFile(str(file_path))
-        info_hash = torrent.info_hash.hex()
-
-        active_torrents[info_hash] = {
-            "name": torrent.name,
-            "total_size": torrent.total_size,
-            "piece_count": len(torrent.pieces),
-            "tracker": torrent.announce,
-            "status": "paused",
-            "progress": 0,
-            "download_speed": 0,
-            "upload_speed": 0,
-            "peers_connected": 0,
-            "downloaded_pieces": 0,
-            "torrent": torrent,
-        }
+        torrent = torrent_cache.load(file_path, content)
+        info_hash = register_torrent(torrent)
 
         await manager.broadcast({
             "type": "torrent_added",
@@ -109,7 +178,7 @@ async def start_torrent(info_hash: str):
         raise HTTPException(status_code=404, detail="Torrent not found")
 
     active_torrents[info_hash]["status"] = "downloading"
-    asyncio.create_task(download_torrent_threading(info_hash))
+    asyncio.create_task(download_torrent(info_hash))
 
     await manager.broadcast({
         "type": "status_update",
@@ -139,7 +208,8 @@ async def delete_torrent(info_hash: str):
     if info_hash not in active_torrents:
         raise HTTPException(status_code=404, detail="Torrent not found")
 
-    del active_torrents[info_hash]
+    torrent = active_torrents.pop(info_hash)["torrent"]
+    torrent_cache.remove(torrent.filepath) #not loaded again on restart, the file itself is kept
     await manager.broadcast({"type": "torrent_removed", "info_hash": info_hash})
     return {"success": True}
 
@@ -152,147 +222,186 @@ async def websocket_endpoint(websocket: WebSocket):
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
-def try_connect_peer_sync(ip, port, info_hash, peer_id):
-    peer = PeerConnection(ip, port, info_hash, peer_id)
+async def try_connect_peer(ip, port, info_hash, peer_id, piece_count, have_pieces=None):
+    """
+    connect and handshake, each stage with its own deadline, then tell the peer
+    what we have and that we are interested. Waiting for UNCHOKE is left to the
+    peer's worker, so it starts requesting the moment this peer unchokes us
+    Returns:
+        AsyncPeerConnection or None
+    """
+    peer = AsyncPeerConnection(ip, port, info_hash, peer_id, piece_count)
     try:
-        if not peer.connect(timeout=1):
+        if not await peer.connect(timeout=CONNECT_TIMEOUT):
             return None
 
-        peer.handshake()
-        peer.send_interested()
-
-        for _ in range(5):
-            msg = peer.receive_message(timeout=1)
-            if msg is None:
-                continue
-            if msg[0] == 5:
-                continue
-            if msg[0] == 1:
-                return peer
+        await peer.handshake(timeout=HANDSHAKE_TIMEOUT)
+        if have_pieces is not None: #tell the peer what we can upload (HAVE_ALL for fast peers as a seed)
+            peer.send_pieces(have_pieces)
+        if have_pieces is None or not have_pieces.all():
+            peer.send_interested()
+        return peer
 
+    except Exception:
         peer.close()
         return None
 
-    except:
-        try:
-            peer.close()
-        except:
-            pass
-        return None
-
-async def download_torrent_threading(info_hash: str):
+async def reannounce(tracker, pool, event=None):
+    """
+    announce in a thread and hand the peers to the pool, failures only get logged
+    (the pool keeps working with the candidates it has)
+    Returns:
+        bool: True if the tracker answered
+    """
+    try:
+        peers_list = await asyncio.to_thread(tracker.get_peers, event)
+    except Exception as e:
+        print(f"Announce failed: {e}")
+        return False
+    added = pool.add(peers_list)
+    if added:
+        print(f"Tracker: {added} new peers, {len(pool.candidates)} known")
+    pool.refill()
+    return True
+
+async def download_torrent(info_hash: str):
     if info_hash not in active_torrents:
         return
 
     data = active_torrents[info_hash]
     torrent = data["torrent"]
-
-    last_downloaded = 0
-    last_time = asyncio.get_event_loop().time() #last time speed
+    piece_manager = None
 
     try:
         print(f"Starting download: {torrent.name}")
 
+        #resume file / recheck of existing data can take a while, keep the loop free,
+        #the first announce runs meanwhile (its "left" is corrected by the next one)
         tracker = TrackerClient(torrent)
-        peers_list = tracker.get_peers()
-
-        if not peers_list:
-            data["status"] = "error"
-            return
+        loading = asyncio.create_task(asyncio.to_thread(PieceManager, torrent))
+        try:
+            peers_list = await asyncio.to_thread(tracker.get_peers)
+            started = True
+        except Exception as e: #tracker down: retried like an empty pool, after min_interval
+            print(f"Announce failed: {e}")
+            peers_list = []
+            started = False
+        finally:
+            piece_manager = await loading
+        tracker.left = torrent.total_size - piece_manager.downloaded_bytes
+
+        progress = piece_manager.get_progress()
+        data["progress"] = progress["percentage"]
+        data["downloaded_pieces"] = progress["completed_pieces"]
+
+        if piece_manager.have_pieces.all(): #everything already on disk, only seed
+            data["status"] = "completed"
+            await manager.broadcast({"type": "completed", "info_hash": info_hash, "status": "completed"})
+
+        last_resume_save = asyncio.get_event_loop().time()
+        last_rechoke = 0
 
         print(f"Got {len(peers_list)} peers from tracker")
-        print(f"Connecting to peers in parallel")
-
-        with ThreadPoolExecutor(max_workers=50) as executor: #parallelism
-            futures = [
-                executor.submit(try_connect_peer_sync, ip, port, torrent.info_hash, tracker.peer_id)
-                for ip, port in peers_list[:50]
-            ]
-            results = [f.result() for f in futures]
-
-        active_peers = [p for p in results if p is not None][:20] #limit to number of peers
 
-        if not active_peers:
-            print("No active peers available")
-            data["status"] = "error"
-            return
+        downloader = Downloader(torrent, [], piece_manager, seed=True, limits=data["limits"])
+        total_pieces = torrent.meta.piece_count
 
-        data["peers_connected"] = len(active_peers)
-        print(f"Connected to {len(active_peers)} peers")
+        #downloading, then seeding ("completed") until paused or removed
+        keep_going = lambda: data["status"] in ("downloading", "completed") and info_hash in active_torrents
 
-        downloader = Downloader(torrent, active_peers)
-        total_pieces = len(torrent.pieces)
-        piece_lock = threading.Lock()
+        async def connect(ip, port):
+            return await try_connect_peer(ip, port, torrent.info_hash, tracker.peer_id,
+                                          torrent.meta.piece_count, piece_manager.have_pieces)
 
-        def download_pieces_worker(peer): #потоки
-            while data["status"] == "downloading":
-                with piece_lock:
-                    piece_idx = downloader.piece_manager.get_next_piece_to_download(peer) #index of not downloaded piece
-                    if piece_idx is None:
-                        break
+        async def run(peer): #worker for one connection, the pool replaces it when it ends
+            downloader.add_peer(peer)
+            await downloader.download_from_peer_async(peer, keep_going)
 
-                print(f"Downloading piece {piece_idx} from {peer.ip}")
-                result = downloader.download_piece(peer, piece_idx)
-
-                if not result:
-                    break
-
-        with ThreadPoolExecutor(max_workers=len(active_peers)) as executor: #поток активных пиров
-            futures = [executor.submit(download_pieces_worker, peer) for peer in active_peers]
+        #keeps MAX_PEERS connections alive, dead ones are replaced from the candidates,
+        #every peer's worker starts as soon as its own handshake is done
+        pool = PeerPool(connect, run, target=MAX_PEERS, max_connecting=MAX_CONNECTING)
+        pool.add(peers_list)
+        pool.refill()
+        last_announce = asyncio.get_event_loop().time()
+        announcing = None
+        was_seeding = data["status"] == "completed"
 
+        try:
             #progress speed and show
-            while data["status"] == "downloading":
+            while keep_going():
                 await asyncio.sleep(0.5)
 
                 progress = downloader.piece_manager.get_progress()
 
-                if progress["percentage"] >= 100:
+                if piece_manager.error and data["status"] == "downloading": #e.g. disk full, workers stop
+                    print(f"Error: {piece_manager.error}")
+                    data["status"] = "error"
+
+                if data["status"] == "downloading" and progress["percentage"] >= 100:
                     data["status"] = "completed"
                     data["progress"] = 100.0
-                    break
-
-                current_time = asyncio.get_event_loop().time()
-                time_diff = current_time - last_time
-
-                if time_diff >= 0.5:
-                    bytes_diff = progress["downloaded_bytes"] - last_downloaded
-                    data["download_speed"] = bytes_diff / time_diff if time_diff > 0 else 0
-                    data["upload_speed"] = 0
-                    data["progress"] = progress["percentage"]
-                    data["downloaded_pieces"] = progress["completed_pieces"]
-
-                    last_downloaded = progress["downloaded_bytes"]
-                    last_time = current_time
-
+                    print("Saving to disk")
+                    await asyncio.to_thread(piece_manager.save_to_disk)
+                    print(f"Done: downloads/{torrent.name}, seeding")
                     await manager.broadcast({
-                        "type": "progress_update",
+                        "type": "completed",
                         "info_hash": info_hash,
-                        "progress": data["progress"],
-                        "downloaded_pieces": data["downloaded_pieces"],
-                        "download_speed": data["download_speed"],
-                        "upload_speed": 0,
-                        "peers_connected": len(active_peers),
-                        "status": "downloading"
+                        "status": "completed"
                     })
 
-                    print(f"Progress: {data['progress']:.1f}% Speed: {data['download_speed']/1024/1024:.2f} MB/s Pieces: {data['downloaded_pieces']}/{total_pieces}")
-
-            for f in futures:
-                f.result()
-
-        if data["status"] == "completed":
-            print("Saving to disk")
-            downloader.piece_manager.save_to_disk()
-            print(f"Done: downloads/{torrent.name}")
-
-            await manager.broadcast({
-                "type": "completed",
-                "info_hash": info_hash,
-                "status": "completed"
-            })
+                current_time = asyncio.get_event_loop().time()
 
-        for peer in active_peers:
-            peer.close()
+                if current_time - last_rechoke >= Choker.INTERVAL:
+                    downloader.rechoke()
+                    last_rechoke = current_time
+
+                pool.refill() #replaces peers that died since the last tick
+                #counters are kept up to date per block, speed is a rolling window
+                data["download_speed"] = progress["download_speed"]
+                data["upload_speed"] = progress["upload_speed"]
+                data["progress"] = progress["percentage"]
+                data["downloaded_pieces"] = progress["completed_pieces"]
+                data["peers_connected"] = len(pool.live)
+                tracker.uploaded = piece_manager.stats.uploaded
+                tracker.downloaded = piece_manager.stats.received
+                tracker.left = torrent.total_size - piece_manager.downloaded_bytes
+
+                #regular re-announce, sooner when the pool runs out of addresses, "completed" once
+                if announcing is None or announcing.done():
+                    if announcing is not None and announcing.result():
+                        started = True
+                    since = current_time - last_announce
+                    event = None if started else "started" #until the tracker has seen us once
+                    due = since >= tracker.interval or (pool.starving() and since >= tracker.min_interval)
+                    if data["status"] == "completed" and not was_seeding:
+                        event, was_seeding, due = "completed", True, True
+                    if due:
+                        announcing = asyncio.create_task(reannounce(tracker, pool, event))
+                        last_announce = current_time
+
+                await manager.broadcast({
+                    "type": "progress_update",
+                    "info_hash": info_hash,
+                    "progress": data["progress"],
+                    "downloaded_pieces": data["downloaded_pieces"],
+                    "download_speed": data["download_speed"],
+                    "upload_speed": data["upload_speed"],
+                    "peers_connected": data["peers_connected"],
+                    "status": data["status"]
+                })
+
+                if data["status"] == "downloading":
+                    print(f"Progress: {data['progress']:.1f}% Speed: {data['download_speed']/1024/1024:.2f} MB/s Pieces: {data['downloaded_pieces']}/{total_pieces} Peers: {data['peers_connected']}")
+
+                    if current_time - last_resume_save >= RESUME_SAVE_INTERVAL:
+                        await asyncio.to_thread(piece_manager.save_resume)
+                        last_resume_save = current_time
+
+        finally:
+            if announcing is not None:
+                announcing.cancel()
+            await pool.close()
+            data["peers_connected"] = 0
 
     except Exception as e:
         print(f"Error: {e}")
@@ -300,6 +409,14 @@ async def download_torrent_threading(info_hash: str):
         traceback.print_exc()
         data["status"] = "error"
 
+    finally:
+        #paused, stopped or failed: keep what we have for next start (also closes the files and seeding mmaps)
+        if piece_manager is not None:
+            try:
+                await asyncio.to_thread(piece_manager.save_to_disk)
+            except Exception as e:
+                print(f"Error saving {torrent.name}: {e}")
+
 app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
 
 if __name__ == "__main__":